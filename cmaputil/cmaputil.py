@@ -7,15 +7,15 @@ Utilities for working with standard colormaps
 """
 #%% Imports
 from __future__ import print_function
-from math import floor, sqrt, ceil
-from os.path import exists
+from collections import OrderedDict
+from math import floor, ceil
+from multiprocessing.pool import ThreadPool
+import os
+from os.path import abspath, dirname, exists, expanduser, join
+import tempfile
+import warnings
 
-import matplotlib.cm as cm # Used with eval()
-import matplotlib.patches as mpatches
-import matplotlib.pyplot as plt
-from mpl_toolkits.mplot3d import Axes3D # Used to make 3D axes
 import numpy as np
-import scipy
 
 from colorspacious import cspace_convert
 
@@ -36,10 +36,52 @@ CSPACE1 = 'sRGB1'
 CSPACE2 = 'CAM02-UCS'
 FLABEL = 20  # font size for labels (title and axis labels)
 FAX = 16  # font size for numbers on axes
+CACHE_DIR = os.environ.get('CMAPUTIL_CACHE',
+                           join(expanduser('~'), '.cache', 'cmaputil'))
+GAMUT_LIM = 50  # gamut table covers a' and b' in [-GAMUT_LIM, GAMUT_LIM]
+GAMUT_STEP = 0.5  # a'b' grid spacing of the gamut table
+_GAMUT_TABLES = {}  # gamut tables already loaded by this process
+CMAP_DIR = join(dirname(abspath(__file__)), 'colormaps')
+SHIPPED_CMAPS = {'cividis': 'cividis.txt'}  # colormaps found in CMAP_DIR
+CMAP_CACHE_SIZE = 128  # max colormaps kept in the RGB/J'a'b' cache
+_CMAP_CACHE = OrderedDict()  # name -> [rgb, jab], least recently used first
+_REGISTERED = {}  # colormaps added with register_cmap
+_UCS_CONSTANTS = {}  # sRGB1 <-> CAM02-UCS constants for each dtype
+CONVERT_TOL = {'float64': 1e-9, 'float32': 1e-3}  # max error vs colorspacious
 
 #%% Colormap Processing Functions
 
 
+def _mpl_cmap(name):
+    '''
+    Returns the matplotlib colormap with this name or None if there is
+    no such colormap (or matplotlib is not installed).
+    '''
+    try:
+        import matplotlib
+    except ImportError:
+        return None
+    try:
+        return matplotlib.colormaps[name]
+    except KeyError:
+        return None
+    except AttributeError:  # matplotlib < 3.5
+        import matplotlib.cm as cm
+        try:
+            return cm.get_cmap(name)
+        except ValueError:
+            return None
+
+
+def _in_registry(cmap):
+    '''
+    Returns whether the name is a registered, shipped or matplotlib
+    colormap (all of which are cached by get_rgb_jab).
+    '''
+    return (cmap in _REGISTERED or cmap in SHIPPED_CMAPS or
+            _mpl_cmap(cmap) is not None)
+
+
 def _check_cmap(cmap):
     '''
     Checks passed cmap name. If it is invalid, throws ValueError.
@@ -47,21 +89,81 @@ def _check_cmap(cmap):
 
     To use a custom-made colormap, save it to a .npy file then use the
     path and file name (e.g. 'path\example' for path\example.npy') as
-    the cmap variable name.
+    the cmap variable name, or add it with register_cmap.
+
+    A name is considered invalid when it is not a registered colormap,
+    a colormap shipped with this package (SHIPPED_CMAPS), a matplotlib
+    colormap or the name of a .npy file.
+    '''
+
+    if cmap is None or not _in_registry(cmap):
+        if cmap is None or not exists(cmap + '.npy'):
+            raise ValueError(str(cmap) + ' not a valid colormap name.')
+    return
+
+
+def register_cmap(name, data):
+    '''
+    Adds a colormap to the registry so it can be used by name.
+    Replaces any colormap already registered with this name.
 
-    A name is considered invalid when not included in the CMAPS
-    variable and a .npy file with its name could not be found. This
-    list is manually created so it could be out of date depending on
-    the time of this code's release.
+    Parameters
+    -----------
+    name : string
+        Name to use for the colormap
+    data : 3 x N or N x 3 array
+        RGB values (0-1) of the colormap
     '''
 
-    if cmap is None or cmap not in CMAPS:
-        if not exists(cmap + '.npy'):
-            raise ValueError(cmap + ' not a valid colormap name.')
+    rgb = np.array(data, dtype=float)
+    if rgb.shape[0] != 3:
+        rgb = rgb.T
+    _REGISTERED[name] = np.clip(rgb, 0, 1)
+    _CMAP_CACHE.pop(name, None)
     return
 
 
-def create_isoluminant_map(data):
+def _iso_rgb(jab, Js):
+    '''
+    Converts the a'b' pairs of jab at each J' value in Js to RGB in a
+    single conversion. Returns a 3 x N x len(Js) array.
+    '''
+    Js = np.asarray(Js, dtype=float)
+    m = np.empty((3, jab.shape[1], len(Js)))
+    m[0] = Js
+    m[1:] = np.asarray(jab)[1:, :, np.newaxis]
+    return convert(m, CSPACE2, CSPACE1, out=m)
+
+
+class IsoluminantMaps(object):
+    '''
+    Isoluminant colormaps of one colormap, converted to RGB only when
+    indexed (see create_isoluminant_map). maps[x] is the same as
+    m[:, :, x] of the full matrix and slicing returns a 3 x 256 x K
+    matrix. The J' value of each map is in maps.J.
+    '''
+
+    def __init__(self, jab, J):
+        self.jab = np.array(jab, dtype=float)
+        self.J = J
+
+    def __len__(self):
+        return len(self.J)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return _iso_rgb(self.jab, self.J[index])
+        return _iso_rgb(self.jab, [self.J[index]])[:, :, 0]
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def to_array(self):
+        return self[:]
+
+
+def create_isoluminant_map(data, step=1, lazy=False):
     '''
     Takes in a colormap (name or RGB values) and cycles through all
     possible intensity values that are valid for all a',b' pairs
@@ -75,11 +177,19 @@ def create_isoluminant_map(data):
     -----------
     data: str or ndarray
         Colormap name or RGB values
+    step: float
+        Change in J' between neighboring isoluminant colormaps. Default
+        value is 1.
+    lazy: boolean
+        If True, an IsoluminantMaps object is returned instead, which
+        only converts the isoluminant colormaps that are indexed. Uses
+        no extra memory however small step is. Default value is False.
 
     Returns
     -----------
     rgb: ndarray, dimensions = (3, 256, X)
         Isoluminant colormap matrix containing X isoluminant colormaps
+        (IsoluminantMaps if lazy is True)
 
     '''
 
@@ -90,36 +200,72 @@ def create_isoluminant_map(data):
     if minJ is None:
         return None
 
-    # Continue if passed
-    h = int(maxJ) - int(minJ)
-    rgb = np.zeros((jab.shape[0], jab.shape[1], h))
-    for j in range(h):
-        jab[0, :] = int(minJ) + j
-        rgb[:, :, j] = convert(jab, CSPACE2, CSPACE1)
+    # Continue if passed (J' multiples of step within the bounds)
+    J = step * np.arange(ceil(minJ / step), floor(maxJ / step) + 1)
+    if lazy:
+        return IsoluminantMaps(jab, J)
+    return _iso_rgb(jab, J)
 
-    return rgb
+
+def _valid_jab(j, a, b):
+    '''
+    Returns whether each J'a'b' value (j, a and b are broadcast
+    together) converts to a valid RGB value.
+    '''
+    j, a, b = np.broadcast_arrays(j, a, b)
+    test_rgb = _ucs_to_srgb(j, a, b)
+    return _valid_rgb(test_rgb[0]) & _valid_rgb(test_rgb[1]) & \
+        _valid_rgb(test_rgb[2])
 
 
-def _find_J_bounds(j, a, b):
+def _bisect_J(good, bad, a, b, tol):
     '''
-    Tests J' values against a'b' pairs to determine the max range,
-    within the range given by [j, maxj], of J's that can be used with
-    this pair. Recursive function.
+    Moves each valid J' (good) towards its invalid neighbor (bad) by
+    bisection until they are within tol. Returns the valid side.
+    '''
+    good = np.array(good, dtype=float)
+    bad = np.array(bad, dtype=float)
+    while np.any(np.abs(good - bad) > tol):
+        mid = (good + bad) / 2
+        passed = _valid_jab(mid, a, b)
+        good = np.where(passed, mid, good)
+        bad = np.where(passed, bad, mid)
+    return good
+
+
+def _find_J_bounds(a, b, tol=0.01, step=0.5):
+    '''
+    Finds the lowest and highest J' values that work with each a'b'
+    pair. All pairs are tested at once: J' is first scanned on a grid
+    from 0 to 100 (spacing given by step), then each bound is refined
+    by bisection to within tol. Pairs without any valid J' get NaN.
 
     All J'a'b' pairs will convert to a RGB value but not all of these
     values fall within normal color space so they are tested to be
-    between 0 and 255.
+    between 0 and 1.
     '''
 
-    test_rgb = cspace_convert([j, a, b], CSPACE2, CSPACE1)
+    a = np.atleast_1d(np.asarray(a, dtype=float))
+    b = np.atleast_1d(np.asarray(b, dtype=float))
+    grid = np.linspace(0, 100, int(round(100 / step)) + 1)
+    passed = _valid_jab(grid[:, np.newaxis], a, b)
+
+    # First and last grid point that passed for each pair
+    first = np.argmax(passed, axis=0)
+    last = len(grid) - 1 - np.argmax(passed[::-1], axis=0)
+
+    low = _bisect_J(grid[first], grid[np.maximum(first - 1, 0)], a, b, tol)
+    high = _bisect_J(grid[last], grid[np.minimum(last + 1, len(grid) - 1)],
+                     a, b, tol)
 
-    if _valid_rgb(test_rgb[0]) and _valid_rgb(test_rgb[1]) and \
-       _valid_rgb(test_rgb[2]):
-        return True
-    return False
+    found = np.any(passed, axis=0)
+    low[~found] = np.nan
+    high[~found] = np.nan
+    return low, high
 
 
-def find_J_bounds(data, report=True):
+def find_J_bounds(data, report=True, tol=0.01, per_column=False,
+                  table=False):
     '''
     Takes in colormap name or J'a'b' values and finds the maximum and
     minumum J' values that all a'b' pairs fit with. This has to be
@@ -131,102 +277,441 @@ def find_J_bounds(data, report=True):
     Parameters
     -----------
     data: str or ndarray
-        Colormap name or J'a'b' ndarray generated by get_rgb_jab
+        Colormap name, J'a'b' ndarray generated by get_rgb_jab or a
+        single J'a'b' value
     report: boolean
         Decides whether results should be printed to the console.
         Default value is True.
+    tol: float
+        Precision the J' bounds are found to. Default value is 0.01.
+    per_column: boolean
+        Decides whether the bounds of each a'b' pair are also returned.
+        Default value is False.
+    table: boolean
+        Decides whether the bounds are interpolated from the cached
+        sRGB gamut table (see load_gamut_table) instead of solved for.
+        Much faster, but only as precise as the table. Default value
+        is False.
 
     Returns
     -----------
-    minJ : int
-        Lowest J' value that works with all a'b' pairs.
-    maxJ : int
-        Highest J' value that works with all a'b' pairs
+    minJ : float
+        Lowest J' value that works with all a'b' pairs. None if no J'
+        value works with all of them.
+    maxJ : float
+        Highest J' value that works with all a'b' pairs. None if no J'
+        value works with all of them.
+    low : ndarray
+        Lowest J' value that works with each a'b' pair (NaN if none
+        does). Only returned if per_column is True.
+    high : ndarray
+        Highest J' value that works with each a'b' pair (NaN if none
+        does). Only returned if per_column is True.
     '''
 
     # Read in J'a'b' values from variable directly or generate them
     if type(data) == str:
         _, m = get_rgb_jab(data)
     else:
-        m = np.copy(data)
-
-    # Test each a'b' pair for their max and min J'
-    minJ = 0
-    maxJ = 100
-    # possible bug here when len(m.shape) == 1?
-    if m.shape[1] > 3:
-        for i in range(m.shape[1]):
-            a = m[1, i]
-            b = m[2, i]
-            passed = []
-            J = minJ
-            while J <= maxJ:
-                if _find_J_bounds(J, a, b):
-                    passed.append(J)
-                while _find_J_bounds(J + 5, a, b):
-                    passed.append(J)
-                    J += 5
-                J += 0.1
-            if len(passed) > 0:
-                minJ = max(minJ, min(passed))
-                maxJ = min(maxJ, max(passed))
+        m = np.asarray(data, dtype=float)
+    if m.ndim == 1:
+        m = m.reshape(3, 1)
 
+    # Test all a'b' pairs for their max and min J'
+    if table:
+        low, high = query_J_bounds(m[1, :], m[2, :])
+    else:
+        low, high = _find_J_bounds(m[1, :], m[2, :], tol=tol)
+    if np.any(np.isnan(low)) or np.max(low) > np.min(high):
+        minJ, maxJ = None, None
     else:
-        a = m[1]
-        b = m[2]
-        passed = []
-        J = 0.5
-        while J <= 100:
-            if _find_J_bounds(J, a, b):
-                passed.append(J)
-            while _find_J_bounds(J + 5, a, b):
-                passed.append(J)
-                J += 5
-            J += 0.1
-        minJ = min(passed)
-        maxJ = max(passed)
+        minJ, maxJ = float(np.max(low)), float(np.min(high))
 
     if report:
         print('Passed: ' + str([minJ, maxJ]))
+    if per_column:
+        return minJ, maxJ, low, high
     return minJ, maxJ
 
 
-def convert(data, from_space, to_space):
+def _ucs_constants(dtype=np.float64):
+    '''
+    Returns the constants of the sRGB1 <-> CAM02-UCS transform (sRGB
+    viewing conditions, as used by colorspacious), cast to dtype. They
+    are only computed once for each dtype.
+    '''
+    dtype = np.dtype(dtype)
+    if dtype.name in _UCS_CONSTANTS:
+        return _UCS_CONSTANTS[dtype.name]
+
+    # sRGB viewing conditions (colorspacious' CIECAM02Space.sRGB)
+    xyz_w = np.array([95.047, 100, 108.883])
+    y_b = 20.
+    l_a = (64 / np.pi) / 5
+    f, c, n_c = 1.0, 0.69, 1.0
+    c1, c2 = 0.007, 0.0228  # CAM02-UCS coefficients (K_L = 1)
+
+    m_cat02 = np.array([[0.7328, 0.4296, -0.1624],
+                        [-0.7036, 1.6975, 0.0061],
+                        [0.0030, 0.0136, 0.9834]])
+    m_hpe = np.array([[0.38971, 0.68898, -0.07868],
+                      [-0.22981, 1.18340, 0.04641],
+                      [0.00000, 0.00000, 1.00000]])
+    xyz_to_rgb = np.array([[3.2406, -1.5372, -0.4986],
+                           [-0.9689, 1.8758, 0.0415],
+                           [0.0557, -0.2040, 1.0570]])
+
+    rgb_w = np.dot(m_cat02, xyz_w)
+    d = np.clip(f * (1 - (1 / 3.6) * np.exp((-l_a - 42) / 92)), 0, 1)
+    d_rgb = d * xyz_w[1] / rgb_w + 1 - d
+    k = 1 / (5 * l_a + 1)
+    f_l = 0.2 * k ** 4 * (5 * l_a) + \
+        0.1 * (1 - k ** 4) ** 2 * (5 * l_a) ** (1. / 3)
+    n = y_b / xyz_w[1]
+    z = 1.48 + np.sqrt(n)
+    n_bb = 0.725 * (1 / n) ** 0.2
+
+    # Linear sRGB -> adapted, Hunt-Pointer-Estevez RGB' in one matrix
+    adapt = np.dot(np.dot(m_hpe, np.linalg.inv(m_cat02)),
+                   d_rgb[:, np.newaxis] * m_cat02)
+    to_hpe = np.dot(adapt, 100 * np.linalg.inv(xyz_to_rgb))
+    tmp = (f_l * np.dot(adapt, xyz_w) / 100) ** 0.42
+    rgb_aw = 400 * (tmp / (tmp + 27.13)) + 0.1
+    a_w = (np.dot([2, 1, 1. / 20], rgb_aw) - 0.305) * n_bb
+
+    const = {'to_hpe': to_hpe,
+             'from_hpe': np.linalg.inv(to_hpe),
+             'from_p2ab': np.array([[460, 451, 288],
+                                    [460, -891, -261],
+                                    [460, -220, -6300]]) / 1403.,
+             'f_l': f_l, 'n_bb': n_bb, 'a_w': a_w, 'cz': c * z,
+             'e': (12500. / 13) * n_c * n_bb,
+             't': (1.64 - 0.29 ** n) ** 0.73,
+             'm': f_l ** 0.25, 'c1': c1, 'c2': c2,
+             'cos2': np.cos(2.), 'sin2': np.sin(2.)}
+    const = dict((key, np.asarray(val, dtype=dtype)[()])
+                 for key, val in const.items())
+    _UCS_CONSTANTS[dtype.name] = const
+    return const
+
+
+def _mat3(m, x0, x1, x2):
+    # Multiplies 3 x 3 matrix m with the vector (x0, x1, x2) elementwise
+    return (m[0, 0] * x0 + m[0, 1] * x1 + m[0, 2] * x2,
+            m[1, 0] * x0 + m[1, 1] * x1 + m[1, 2] * x2,
+            m[2, 0] * x0 + m[2, 1] * x1 + m[2, 2] * x2)
+
+
+def _srgb_to_ucs(r, g, b, dtype=np.float64, out=None):
+    '''
+    Converts sRGB1 values (r, g and b arrays, clipped to [0, 1]) to
+    CAM02-UCS. Follows the same steps as colorspacious (CIECAM02 with
+    sRGB viewing conditions followed by Luo et al. 2006), with every
+    constant precomputed. Returns a 3 x ... ndarray of J'a'b' values,
+    written to out if given (which may share memory with r, g and b).
+    '''
+    k = _ucs_constants(dtype)
+    lin = []
+    for ch in (r, g, b):
+        ch = np.clip(np.asarray(ch, dtype=dtype), 0, 1)
+        lin.append(np.where(ch < 0.04045, ch / 12.92,
+                            ((ch + 0.055) / 1.055) ** 2.4))
+
+    # Post-adaptation cone responses
+    rgb_a = []
+    for ch in _mat3(k['to_hpe'], *lin):
+        tmp = (k['f_l'] * np.abs(ch) / 100) ** 0.42
+        rgb_a.append(np.sign(ch) * 400 * (tmp / (tmp + 27.13)) + 0.1)
+    ra, ga, ba = rgb_a
+
+    # Opponent dimensions, lightness and colorfulness
+    a = ra - (12. / 11) * ga + (1. / 11) * ba
+    b = (ra + ga - 2 * ba) / 9
+    big_a = (2 * ra + ga + ba / 20 - 0.305) * k['n_bb']
+    j = 100 * (big_a / k['a_w']) ** k['cz']
+    r = np.hypot(a, b)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        cos_h = np.where(r > 0, a / r, 1)
+        sin_h = np.where(r > 0, b / r, 0)
+    e = k['e'] * (cos_h * k['cos2'] - sin_h * k['sin2'] + 3.8)
+    t = e * r / (ra + ga + (21. / 20) * ba)
+    m = t ** 0.9 * np.sqrt(j / 100) * k['t'] * k['m']
+
+    # CAM02-UCS
+    jab = np.empty((3,) + j.shape, dtype=dtype) if out is None else out
+    jab[0] = (1 + 100 * k['c1']) * j / (1 + k['c1'] * j)
+    mp = np.log1p(k['c2'] * m) / k['c2']
+    jab[1] = mp * cos_h
+    jab[2] = mp * sin_h
+    return jab
+
+
+def _ucs_to_srgb(jp, ap, bp, dtype=np.float64, out=None):
+    '''
+    Converts CAM02-UCS values (jp, ap and bp arrays) to sRGB1, the
+    inverse of _srgb_to_ucs. Values outside of the sRGB gamut are not
+    clipped (and may be NaN). Returns a 3 x ... ndarray of RGB values,
+    written to out if given (which may share memory with jp, ap and
+    bp).
+    '''
+    k = _ucs_constants(dtype)
+    jp = np.asarray(jp, dtype=dtype)
+    ap = np.asarray(ap, dtype=dtype)
+    bp = np.asarray(bp, dtype=dtype)
+
+    # Lightness, colorfulness and hue
+    j = -jp / (k['c1'] * jp - 100 * k['c1'] - 1)
+    mp = np.hypot(ap, bp)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        cos_h = np.where(mp > 0, ap / mp, 1)
+        sin_h = np.where(mp > 0, bp / mp, 0)
+        c = np.expm1(k['c2'] * mp) / k['c2'] / k['m']
+        t = (c / (np.sqrt(j / 100) * k['t'])) ** (1 / 0.9)
+    t = np.where(c > 0, t, 0)
+    e = (cos_h * k['cos2'] - sin_h * k['sin2'] + 3.8) / 4
+    p2 = k['a_w'] * (j / 100) ** (1 / k['cz']) / k['n_bb'] + 0.305
+
+    # Opponent dimensions (colorspacious' two cases, multiplied by t)
+    num = p2 * t * (2 + 21. / 20) * (460. / 1403)
+    den = 4 * k['e'] * e + \
+        t * ((2 + 21. / 20) * (220. / 1403) * cos_h +
+             (-27. / 1403 + (21. / 20) * (6300. / 1403)) * sin_h)
+    with np.errstate(invalid='ignore'):
+        a = num * cos_h / den
+        b = num * sin_h / den
+
+    # Post-adaptation cone responses back to linear and encoded sRGB
+    rgb = np.empty((3,) + j.shape, dtype=dtype) if out is None else out
+    lin = []
+    with np.errstate(invalid='ignore'):
+        for ch in _mat3(k['from_p2ab'], p2, a, b):
+            ch = ch - 0.1
+            lin.append(np.sign(ch) * (100 / k['f_l']) *
+                       ((27.13 * np.abs(ch)) / (400 - np.abs(ch))) **
+                       (1 / 0.42))
+        for i, ch in enumerate(_mat3(k['from_hpe'], *lin)):
+            rgb[i] = np.where(ch <= 0.0031308, ch * 12.92,
+                              1.055 * ch ** (1 / 2.4) - 0.055)
+    return rgb
+
+
+def unique_colors(data, axis=0):
+    '''
+    Finds the distinct colors in an array of colors, e.g. an image
+    colored with a colormap (which holds at most as many colors as the
+    colormap).
+
+    Parameters
+    -----------
+    data: 3 x ... array
+        Color values, with the 3 color components along axis
+    axis: int
+        Axis of data holding the 3 color components. Default value is
+        0.
+
+    Returns
+    -----------
+    colors : U x 3 ndarray
+        Distinct colors in data
+    inverse : ndarray
+        Index in colors of each color of data (flattened, with the
+        color axis removed)
+    '''
+    data = np.ascontiguousarray(np.moveaxis(np.asarray(data), axis, -1))
+    data = data.reshape(-1, 3)
+    size = data.dtype.itemsize
+    if size not in (1, 2, 4, 8) or len(data) == 0:
+        return _unique_rows(data)
+
+    # One key per color: the packed color if it fits in 64 bits, else
+    # a hash of it (checked below). Keys are then scrambled so their
+    # top bits can index a table.
+    bits = data.view('u%d' % size)
+    keys = bits.astype(np.uint64)
+    if size <= 2:
+        keys = (keys[:, 0] << np.uint64(16 * size)) | \
+            (keys[:, 1] << np.uint64(8 * size)) | keys[:, 2]
+    else:
+        keys = (keys[:, 0] * np.uint64(0xC2B2AE3D27D4EB4F)) ^ \
+            (keys[:, 1] * np.uint64(0x165667B19E3779F9)) ^ keys[:, 2]
+    keys *= np.uint64(0x9E3779B97F4A7C15)
+
+    # Distinct keys: those in a sample of the colors first, then any
+    # that the sample missed (few, if the colors repeat)
+    found = np.unique(keys[::max(len(keys) // 65536, 1)])
+    while True:
+        inverse = _key_index(found, keys)
+        missed = found[inverse] != keys
+        if not np.any(missed):
+            break
+        found = np.union1d(found, keys[missed])
+
+    colors = np.empty((len(found), 3), dtype=data.dtype)
+    colors[inverse] = data
+    if size > 2 and not np.array_equal(np.take(colors.view(bits.dtype),
+                                               inverse, axis=0), bits):
+        return _unique_rows(data)  # hash collision
+    return colors, inverse
+
+
+def _key_index(found, keys):
+    '''
+    Returns the position of each of keys in found (sorted, distinct
+    keys). Uses a table indexed by the top bits of the keys if these
+    tell the keys in found apart, else a binary search. Keys missing
+    from found get any position.
+    '''
+    for b in range(len(found).bit_length() + 1, 21):
+        shift = np.uint64(64 - b)
+        slots = found >> shift
+        if len(np.unique(slots)) == len(found):
+            table = np.zeros(2 ** b, dtype=np.intp)
+            table[slots] = np.arange(len(found))
+            return np.take(table, keys >> shift)
+    return np.minimum(np.searchsorted(found, keys), len(found) - 1)
+
+
+def _unique_rows(data):
+    # Distinct rows of N x 3 array data by sorting their raw bytes
+    rows = data.view(np.dtype((np.void, 3 * data.dtype.itemsize))).ravel()
+    _, first, inverse = np.unique(rows, return_index=True,
+                                  return_inverse=True)
+    return data[first], inverse.ravel()
+
+
+def convert(data, from_space, to_space, dtype=None, axis=0, out=None,
+            unique=False):
     '''
     Takes a single color value or matrix of values and converts to the
-    desired colorspace
+    desired colorspace. Conversions between CSPACE1 (sRGB1) and CSPACE2
+    (CAM02-UCS) use a dedicated transform (_srgb_to_ucs and
+    _ucs_to_srgb) that agrees with colorspacious to within CONVERT_TOL
+    (1e-9 in double precision and 1e-3 in single precision, see
+    check_convert). Other colorspaces are converted with colorspacious.
 
     Parameters
     -----------
-    data: 3 x COL array
-        Colormap name OR array with complete color data. Invalid
-        colormap names throw a ValueError. Refer to _check_cmap for
-        more information.
+    data: 3 x ... array
+        Color values, with the 3 color components along axis (e.g. an
+        H x W x 3 image with axis=-1).
     from_space: str
         Colorspace the current color value(s) reside(s) in
     to_space: str
         Colorspace to convert the color value(s) to
+    dtype: data-type
+        Precision of the sRGB1 <-> CAM02-UCS transform. np.float32 is
+        faster and uses half the memory. Default value is None
+        (np.float64).
+    axis: int
+        Axis of data (and of the result) holding the 3 color
+        components. Default value is 0.
+    out: ndarray
+        Array with the shape of data the result is written to. Can be
+        data itself. Default value is None (a new array).
+    unique: boolean
+        If True, only the distinct colors in data are converted (see
+        unique_colors) and the results copied to each color. Faster
+        for images with few colors, e.g. colored with a colormap.
+        Default value is False.
 
     Returns
     -----------
-    n : 3 x COL ndarray
-        RGB values for each converted color value
+    n : 3 x ... ndarray
+        Converted color values, laid out like data
     '''
-    if from_space == CSPACE1:
-        data = np.clip(data, 0, 1)
-    new = cspace_convert(data.T, from_space, to_space).T
+    if dtype is None:
+        dtype = np.float64
+    data = np.asarray(data)
+    if out is None:
+        out = np.empty(data.shape, dtype=dtype)
+
+    if unique:
+        colors, inverse = unique_colors(data, axis)
+        colors = convert(colors, from_space, to_space, dtype=dtype,
+                         axis=-1)
+        new = np.moveaxis(out, axis, -1)
+        new[...] = np.take(colors, inverse, axis=0).reshape(new.shape)
+        return out
+
+    data = np.moveaxis(data, axis, 0)
+    new = np.moveaxis(out, axis, 0)
+
+    if from_space == CSPACE1 and to_space == CSPACE2:
+        _srgb_to_ucs(data[0], data[1], data[2], dtype=dtype, out=new)
+    elif from_space == CSPACE2 and to_space == CSPACE1:
+        _ucs_to_srgb(data[0], data[1], data[2], dtype=dtype, out=new)
+    else:
+        data = np.moveaxis(data, 0, -1)
+        if from_space == CSPACE1:
+            data = np.clip(data, 0, 1)
+        new[...] = np.moveaxis(cspace_convert(data, from_space, to_space),
+                               -1, 0)
     if to_space == CSPACE1:
-        new = np.clip(new, 0, 1)
-    return new
+        np.clip(out, 0, 1, out=out)
+    return out
+
+
+def check_convert(n=100000, seed=0, report=True):
+    '''
+    Checks the dedicated sRGB1 <-> CAM02-UCS transform used by convert
+    against colorspacious on random sRGB1 and J'a'b' values, in double
+    and single precision. Raises a ValueError if the largest difference
+    is over CONVERT_TOL or if invalid (NaN) colors are not the same.
+
+    Parameters
+    -----------
+    n : int
+        Number of random colors to convert each way. Default value is
+        100000.
+    seed : int
+        Seed of the random colors. Default value is 0.
+    report : boolean
+        Decides whether the largest differences are printed. Default
+        value is True.
+
+    Returns
+    -----------
+    errors : dict
+        Largest difference of J'a'b' ('sRGB1 -> CAM02-UCS') and of RGB
+        ('CAM02-UCS -> sRGB1') for each dtype name
+    '''
+    rng = np.random.RandomState(seed)
+    rgb = rng.uniform(0, 1, (3, n))
+    jab = np.vstack([rng.uniform(0, 100, n), rng.uniform(-50, 50, (2, n))])
+    with np.errstate(invalid='ignore'):
+        ref_jab = cspace_convert(rgb.T, CSPACE1, CSPACE2).T
+        ref_rgb = np.clip(cspace_convert(jab.T, CSPACE2, CSPACE1).T, 0, 1)
+
+    errors = {}
+    for name, tol in CONVERT_TOL.items():
+        dtype = np.dtype(name).type
+        with np.errstate(invalid='ignore'):
+            new_jab = convert(rgb, CSPACE1, CSPACE2, dtype=dtype)
+            new_rgb = convert(jab, CSPACE2, CSPACE1, dtype=dtype)
+        if not np.array_equal(np.isnan(new_rgb), np.isnan(ref_rgb)):
+            raise ValueError('Invalid colors differ from colorspacious '
+                             '(%s).' % name)
+        valid = ~np.isnan(ref_rgb)
+        errors[name] = {
+            CSPACE1 + ' -> ' + CSPACE2: np.max(np.abs(new_jab - ref_jab)),
+            CSPACE2 + ' -> ' + CSPACE1: np.max(np.abs(new_rgb - ref_rgb)[valid])}
+        for direction, error in errors[name].items():
+            if report:
+                print('%s %s: %.2e (max %.0e)' % (name, direction, error, tol))
+            if not error <= tol:
+                raise ValueError('%s %s differs from colorspacious by %.2e '
+                                 '(max %.0e).' % (name, direction, error, tol))
+    return errors
 
 
 def _get_rgb(cmap):
     # Get RGB Values
-    if cmap in CMAPS:
-        rgb = np.zeros((3, 256))
-        c = eval('cm.' + cmap)
-        for i in range(256):
-            rgb[:, i] = c(i)[:-1]
+    if cmap in _REGISTERED:
+        rgb = np.copy(_REGISTERED[cmap])
+    elif cmap in SHIPPED_CMAPS:
+        rgb = np.loadtxt(join(CMAP_DIR, SHIPPED_CMAPS[cmap])).T
+    elif _mpl_cmap(cmap) is not None:
+        rgb = _mpl_cmap(cmap)(np.arange(256))[:, :3].T
     else:
         rgb = np.load(cmap + '.npy')
         if rgb.shape[0] != 3:
@@ -234,10 +719,40 @@ def _get_rgb(cmap):
     return rgb
 
 
+def _rgb_to_jab(rgb):
+    # Convert RGB -> J'a'b'
+    jab = convert(rgb, CSPACE1, CSPACE2)
+
+    # Ensure J' is valid (between 0 and 100)
+    jab[0, :] = np.clip(jab[0, :], 0, 100)
+    return jab
+
+
+def _cached_rgb_jab(cmap, calc_jab=True):
+    '''
+    Returns the cached [rgb, jab] entry of a colormap in the registry,
+    creating it if needed. jab is only computed once it is asked for.
+    The least recently used colormap is dropped once more than
+    CMAP_CACHE_SIZE colormaps are cached.
+    '''
+
+    entry = _CMAP_CACHE.pop(cmap, None)
+    if entry is None:
+        entry = [np.clip(_get_rgb(cmap), 0, 1), None]
+    if calc_jab and entry[1] is None:
+        entry[1] = _rgb_to_jab(entry[0])
+    _CMAP_CACHE[cmap] = entry
+
+    while len(_CMAP_CACHE) > CMAP_CACHE_SIZE:
+        _CMAP_CACHE.popitem(last=False)
+    return entry
+
+
 def get_rgb_jab(data, calc_jab=True):
     '''
     Accepts cmap name or data and creates its corresponding RGB and J'a'b'
-    matrices.
+    matrices. Results for colormap names in the registry (see
+    _check_cmap) are cached, so repeated calls are cheap.
 
     Parameters
     -----------
@@ -258,6 +773,10 @@ def get_rgb_jab(data, calc_jab=True):
     if type(data) == str:
         cmap = data
         _check_cmap(cmap)
+        if _in_registry(cmap):
+            rgb, jab = _cached_rgb_jab(cmap, calc_jab=calc_jab)
+            jab = np.copy(jab) if calc_jab else None
+            return np.copy(rgb), jab
         rgb = _get_rgb(cmap)
 
     # RGB values passed in
@@ -267,19 +786,218 @@ def get_rgb_jab(data, calc_jab=True):
     rgb = np.clip(rgb, 0, 1)
 
     if calc_jab:
-        # Convert RGB -> J'a'b'
-        jab = convert(rgb, CSPACE1, CSPACE2)
-
-        # Ensure J' is valid (between 0 and 100)
-        jab[0, :] = np.clip(jab[0, :], 0, 100)
+        jab = _rgb_to_jab(rgb)
     else:
         jab = None
 
     return rgb, jab
 
 
+#%% Gamut Table Functions
+def _gamut_path(lim, step, tol):
+    return join(CACHE_DIR, 'gamut_J_bounds_%g_%g_%g.npy' % (lim, step, tol))
+
+
+def build_gamut_table(lim=GAMUT_LIM, step=GAMUT_STEP, tol=0.01, path=None,
+                      chunk=4096):
+    '''
+    Finds the lowest and highest valid J' for every a'b' pair on a grid
+    covering [-lim, lim] in both a' and b' and saves the result to the
+    cache directory (CACHE_DIR, set with the CMAPUTIL_CACHE environment
+    variable). Pairs outside of the sRGB gamut at every J' are NaN.
+
+    Parameters
+    -----------
+    lim : float
+        Grid covers a' and b' values between -lim and lim.
+        Default value is GAMUT_LIM.
+    step : float
+        Grid spacing. Default value is GAMUT_STEP.
+    tol : float
+        Precision of the J' bounds. Default value is 0.01.
+    path : string
+        File to save the table to. Default is a file in CACHE_DIR named
+        after the grid parameters.
+    chunk : int
+        Number of a'b' pairs solved at once. Default value is 4096.
+
+    Returns
+    -----------
+    table : 2 x N x N ndarray
+        Lowest (table[0]) and highest (table[1]) valid J' with a' along
+        the first grid axis and b' along the second.
+    '''
+
+    n = int(round(2 * lim / step)) + 1
+    ab = np.linspace(-lim, lim, n)
+    a, b = np.meshgrid(ab, ab, indexing='ij')
+    a = a.ravel()
+    b = b.ravel()
+
+    table = np.empty((2, n * n))
+    for i in range(0, n * n, chunk):
+        table[:, i:i + chunk] = _find_J_bounds(a[i:i + chunk], b[i:i + chunk],
+                                               tol=tol)
+    table = table.reshape(2, n, n)
+
+    # Write to a temporary file first so other processes never load a
+    # partially written table
+    if path is None:
+        path = _gamut_path(lim, step, tol)
+    folder = os.path.dirname(os.path.abspath(path))
+    if not exists(folder):
+        os.makedirs(folder)
+    fd, tmp = tempfile.mkstemp(dir=folder, suffix='.npy')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            np.save(f, table)
+        os.chmod(tmp, 0o644)
+        os.replace(tmp, path)
+    except BaseException:
+        os.remove(tmp)
+        raise
+
+    return table
+
+
+def load_gamut_table(lim=GAMUT_LIM, step=GAMUT_STEP, tol=0.01,
+                     rebuild=False):
+    '''
+    Returns the sRGB gamut table for the given grid parameters (see
+    build_gamut_table), memory-mapped from the cache directory. The
+    table is built and saved the first time it is requested. Loaded
+    tables are kept for the life of the process.
+    '''
+
+    key = (lim, step, tol)
+    if key in _GAMUT_TABLES and not rebuild:
+        return _GAMUT_TABLES[key]
+
+    path = _gamut_path(lim, step, tol)
+    if rebuild or not exists(path):
+        build_gamut_table(lim=lim, step=step, tol=tol, path=path)
+    _GAMUT_TABLES[key] = np.load(path, mmap_mode='r')
+    return _GAMUT_TABLES[key]
+
+
+def query_J_bounds(a, b, lim=GAMUT_LIM, step=GAMUT_STEP, tol=0.01):
+    '''
+    Looks up the lowest and highest valid J' of each a'b' pair by
+    bilinear interpolation of the cached sRGB gamut table. Pairs
+    outside the table, or next to a grid point without any valid J',
+    get NaN.
+
+    Parameters
+    -----------
+    a : float or array
+        a' value(s)
+    b : float or array
+        b' value(s), same shape as a
+    lim, step, tol : float
+        Grid parameters of the table used. See build_gamut_table.
+
+    Returns
+    -----------
+    low : ndarray
+        Lowest valid J' of each pair
+    high : ndarray
+        Highest valid J' of each pair
+    '''
+
+    table = load_gamut_table(lim=lim, step=step, tol=tol)
+    n = table.shape[1]
+
+    # Position of each pair on the grid
+    fa = (np.atleast_1d(np.asarray(a, dtype=float)) + lim) / step
+    fb = (np.atleast_1d(np.asarray(b, dtype=float)) + lim) / step
+    outside = (fa < 0) | (fa > n - 1) | (fb < 0) | (fb > n - 1)
+    ia = np.clip(np.floor(fa), 0, n - 2).astype(np.intp)
+    ib = np.clip(np.floor(fb), 0, n - 2).astype(np.intp)
+    ta = np.clip(fa - ia, 0, 1)
+    tb = np.clip(fb - ib, 0, 1)
+
+    bounds = (table[:, ia, ib] * (1 - ta) * (1 - tb) +
+              table[:, ia + 1, ib] * ta * (1 - tb) +
+              table[:, ia, ib + 1] * (1 - ta) * tb +
+              table[:, ia + 1, ib + 1] * ta * tb)
+    bounds[:, outside] = np.nan
+    return bounds[0], bounds[1]
+
+
 #%% Image Processing Functions
-def _adjust_bounds(a, minimum, maximum):
+class RunningStats(object):
+    '''
+    Statistics of data that is fed in chunk by chunk (e.g. frames of a
+    time series or tiles of an image) with update. Keeps the count,
+    mean and variance (chunks are merged with Welford's method), min
+    and max and, if sample_size is given, a uniform random sample of
+    the data (reservoir sampling) for approximate percentiles.
+
+    Once all chunks are in, pass the object as stats to normalize or
+    _adjust_bounds (or use its min, max and percentiles as vmin and
+    vmax for overlay_colormap) so every chunk is treated the same as
+    if the data had been one array. bound works value by value, so
+    chunks normalized this way can be bounded directly.
+    '''
+
+    def __init__(self, sample_size=None, seed=0):
+        self.count = 0
+        self.mean = 0.0
+        self._m2 = 0.0  # Sum of squared differences from the mean
+        self.min = np.inf
+        self.max = -np.inf
+        self.sample_size = sample_size
+        self.sample = np.empty(0)
+        self._rng = np.random.RandomState(seed)
+
+    def update(self, a):
+        a = np.asarray(a, dtype=float).ravel()
+        n = a.size
+        if n == 0:
+            return self
+
+        # Merge chunk mean and variance
+        mean = np.mean(a)
+        m2 = np.sum((a - mean) ** 2)
+        total = self.count + n
+        delta = mean - self.mean
+        self.mean += delta * n / total
+        self._m2 += m2 + delta ** 2 * self.count * n / total
+        self.min = min(self.min, np.min(a))
+        self.max = max(self.max, np.max(a))
+
+        # Keep each value seen so far in the sample with equal chance
+        if self.sample_size is not None:
+            free = self.sample_size - self.sample.size
+            if free > 0:
+                self.sample = np.concatenate([self.sample, a[:free]])
+            rest = np.arange(max(free, 0), n)
+            seen = self.count + rest + 1
+            keep = self._rng.random_sample(rest.size) * seen < self.sample_size
+            slots = self._rng.randint(0, self.sample_size, np.sum(keep))
+            self.sample[slots] = a[rest[keep]]
+
+        self.count = total
+        return self
+
+    @property
+    def var(self):
+        return self._m2 / self.count if self.count else np.nan
+
+    @property
+    def std(self):
+        return np.sqrt(self.var)
+
+    def percentile(self, q):
+        '''
+        Approximate q-th percentile(s) of all data seen, from the sample.
+        '''
+        if self.sample_size is None:
+            raise ValueError('Percentiles need a sample_size.')
+        return np.percentile(self.sample, q)
+
+
+def _adjust_bounds(a, minimum, maximum, limits=None):
     '''
     Takes in an array and adjusts all values to be between the min and
     max values. Relative magnitude does not change (i.e., numbers still
@@ -293,6 +1011,9 @@ def _adjust_bounds(a, minimum, maximum):
         Minimum value for new array
     maximum : int
         Maximum value for new array
+    limits : tuple
+        Min and max of the data (e.g. when a is one chunk of it).
+        Default is to use the min and max of a.
 
     Returns
     -----------
@@ -301,10 +1022,13 @@ def _adjust_bounds(a, minimum, maximum):
         adjusted to be between the min and max value.
     '''
     r = maximum - minimum
-    new_array = np.copy(a)
-    mult = float(r) / float(np.max(new_array) - np.min(new_array))
-    new_array *= mult  # Change data range
-    new_array += minimum - np.min(new_array)  # Start at min value
+    if limits is None:
+        a_min, a_max = np.min(a), np.max(a)
+    else:
+        a_min, a_max = limits
+    mult = float(r) / float(a_max - a_min)
+    new_array = np.asarray(a) * mult  # Change data range
+    new_array += minimum - a_min * mult  # Start at min value
     return new_array
 
 
@@ -340,7 +1064,34 @@ def bound(a, high, low):
     return new_array
 
 
-def mix_images(img1, img2, cmap, high, low, name=None, maprevolve=False):
+def _build_mix_luts(cmap_jab, minJ, maxJ, levels=None):
+    '''
+    Builds the lookup tables used by mix_images. Returns the
+    isoluminant colormap (N x 3, uint8) at the middle of [minJ, maxJ]
+    and, if levels is given, a levels x N x 3 uint8 table holding the
+    colormap's a'b' pairs at levels evenly spaced J' values between
+    minJ and maxJ. All conversions are done in one call each.
+    '''
+    n = cmap_jab.shape[1]
+    jab = np.empty((n, 3))
+    jab[:, 0] = (maxJ + minJ) / 2
+    jab[:, 1:] = np.transpose(cmap_jab[1:])
+    rgb = convert(jab, CSPACE2, CSPACE1, axis=-1, out=jab)
+    iso_lut = (rgb * 255).astype(np.uint8)
+
+    mix_lut = None
+    if levels is not None:
+        jab = np.empty((levels, n, 3))
+        jab[..., 0] = np.linspace(minJ, maxJ, levels)[:, np.newaxis]
+        jab[..., 1:] = np.transpose(cmap_jab[1:])
+        rgb = convert(jab, CSPACE2, CSPACE1, axis=-1, out=jab)
+        mix_lut = (rgb * 255).astype(np.uint8)
+    return iso_lut, mix_lut
+
+
+def mix_images(img1, img2, cmap, high, low, name=None, maprevolve=False,
+               levels=None, plot=True, workers=None, buffers=False,
+               processes=None, show=True):
     '''
     First, checks if passed colormap is valid for mixing images. It is
     not valid if the colormap itself is not valid or if each a'b' pair
@@ -380,6 +1131,30 @@ def mix_images(img1, img2, cmap, high, low, name=None, maprevolve=False):
         saved for the 3D colormap plot. Extends total computation time
         about 10X. Is considered False is name is None. Default value
         is False.
+    levels : int
+        Number of J' levels between the J' bounds to precompute for
+        the mixed image. If given, a colormap entry x J' level lookup
+        table is built once and both images are rendered by indexing
+        into it (J' of img2 is rounded to the nearest level). If None,
+        J' values are used exactly and converted for the whole image
+        in a single call. Default value is None.
+    plot : boolean
+        Decides whether the 3D colormap plot is made. Default value is
+        True.
+    workers : int
+        Number of threads the images are split over (in blocks of
+        rows). Results are the same as with one thread. Default value
+        is None (one thread).
+    buffers : boolean
+        Decides whether the rotation images of the 3D colormap plot are
+        returned as PNG data instead of saved to files (see
+        plot_3D_colormap). Default value is False.
+    processes : int
+        Number of worker processes the rotation images are rendered
+        in. Default value is None (this process).
+    show : boolean
+        Decides whether the 3D colormap plot is shown. Default value is
+        True.
 
     Returns
     -----------
@@ -389,6 +1164,9 @@ def mix_images(img1, img2, cmap, high, low, name=None, maprevolve=False):
         Img1 colored using the isoluminant colormap generated
     new_rgb : ndarray
         Mixed image
+    frames : list
+        PNG data of each rotation image. Only returned if buffers is
+        True.
     '''
 
     # Find J bounds to use on image (if possible)
@@ -403,41 +1181,59 @@ def mix_images(img1, img2, cmap, high, low, name=None, maprevolve=False):
     # Case 2: Colormap passed! Mixin' time!
     else:
 
-        plot_3D_colormap(cmap_jab, minJ, maxJ, name=name,
-                         maprevolve=maprevolve)
-
-        # Initialize
-        img1_rgb = np.zeros((img1.shape[0], img1.shape[1], 3), dtype=np.uint8)
-        img1_jab = np.zeros((img1.shape[0], img1.shape[1], 2))
-        img1_iso = np.zeros(img1_rgb.shape, dtype=np.uint8)
-        new_rgb = np.zeros(img1_rgb.shape, dtype=np.uint8)
-
-        # Save RGB & J'a'b' values corresponding to colormap
-        for i in range(img1.shape[0]):
-            for j in range(img1.shape[1]):
-                value = int(round((img1[i, j] - low) * 255 / (high - low)))
-                trgb = cmap_rgb[:, value]
-                tjab = cmap_jab[:, value]
-                img1_rgb[i, j, :] = [trgb[0] * 255, trgb[1] * 255,
-                                     trgb[2] * 255]
-                img1_jab[i, j, :] = [tjab[1], tjab[2]]
-
-        # Combine a' & b' values of Img1 with J' of Img2
-        j_values = _adjust_bounds(img2, minJ, maxJ)
-        for i in range(img1.shape[0]):
-            for j in range(img1.shape[1]):
-                if img1[i, j] > low:
-                    a = img1_jab[i, j, 0]
-                    b = img1_jab[i, j, 1]
-                    img1_iso[i, j, :] = convert([(maxJ + minJ) / 2, a, b],
-                                                CSPACE2, CSPACE1) * 255
-                    new_rgb[i, j, :] = convert([j_values[i, j], a, b],
-                                               CSPACE2, CSPACE1) * 255
-
+        frames = None
+        if plot:
+            frames = plot_3D_colormap(cmap_jab, minJ, maxJ, name=name,
+                                      maprevolve=maprevolve, buffers=buffers,
+                                      processes=processes, show=show)
+
+        # Lookup tables and J' range of img2, shared by all blocks
+        n = cmap_rgb.shape[1]
+        rgb_lut = _build_lut(cmap_rgb)
+        ab_lut = np.transpose(cmap_jab[1:])
+        iso_lut, mix_lut = _build_mix_luts(cmap_jab, minJ, maxJ, levels)
+        img1 = np.asarray(img1)
+        img2 = np.asarray(img2)
+        img2_limits = float(np.min(img2)), float(np.max(img2))
+
+        img1_rgb = np.empty(img1.shape + (3,), dtype=np.uint8)
+        img1_iso = np.empty(img1_rgb.shape, dtype=np.uint8)
+        new_rgb = np.empty(img1_rgb.shape, dtype=np.uint8)
+
+        def mix_block(rows):
+
+            # Colormap index of each pixel and background mask
+            value = _lut_indices(img1[rows], n, low, high)
+            fg = img1[rows] > low
+
+            # Color img1 with the colormap and its isoluminant version
+            img1_rgb[rows] = np.take(rgb_lut, value, axis=0)
+            iso = np.take(iso_lut, value, axis=0)
+            iso[~fg] = 0
+            img1_iso[rows] = iso
+
+            # Combine a' & b' values of Img1 with J' of Img2
+            if mix_lut is not None:
+                j_index = _lut_indices(img2[rows], levels, *img2_limits)
+                new = mix_lut[j_index, value]
+            else:
+                jab = np.empty(value.shape + (3,))
+                jab[..., 0] = _adjust_bounds(img2[rows], minJ, maxJ,
+                                             img2_limits)
+                jab[..., 1:] = np.take(ab_lut, value, axis=0)
+                new = convert(jab, CSPACE2, CSPACE1, axis=-1, out=jab)
+                new *= 255
+                new = new.astype(np.uint8)
+            new[~fg] = 0
+            new_rgb[rows] = new
+
+        _map_blocks(mix_block, img1.shape[0], workers)
+        if buffers:
+            return img1_rgb, img1_iso, new_rgb, frames
         return img1_rgb, img1_iso, new_rgb
 
 
-def normalize(a):
+def normalize(a, stats=None):
     '''
     Normalize array so the average is at 0 and the std. dev. is 1.
 
@@ -445,6 +1241,9 @@ def normalize(a):
     -----------
     a : array
         Array to be normalized
+    stats : RunningStats
+        Statistics to take the average and std. dev. from (e.g. when a
+        is one chunk of the data). Default is to use those of a.
 
     Returns
     -----------
@@ -452,22 +1251,23 @@ def normalize(a):
         Normalized array. Same size as the original array.
     '''
 
-    new_array = np.copy(a)
-    return (new_array - np.average(new_array)) / np.std(new_array)
+    if stats is None:
+        return (a - np.average(a)) / np.std(a)
+    return (np.asarray(a, dtype=float) - stats.mean) / stats.std
 
 
 #%% Math Functions
 def _find_distance(p1, p2):
     '''
     Finds the distance between two points. Must be the same length.
+    Also works on arrays of points (one point per column).
     '''
 
-    if len(p1) != len(p2):
-        return ValueError
-    val = 0
-    for i in range(len(p1)):
-        val += (p2[i] - p1[i]) ** 2
-    return sqrt(val)
+    p1 = np.asarray(p1, dtype=float)
+    p2 = np.asarray(p2, dtype=float)
+    if p1.shape != p2.shape:
+        raise ValueError('Points must be the same length.')
+    return np.sqrt(np.sum((p2 - p1) ** 2, axis=0))
 
 
 def _rnt(num, shift='None'):
@@ -487,10 +1287,21 @@ def _valid_rgb(num, e=0.001):
     Returns whether or not the number is both finite and between 0 and 1
     (within allowed error) to test whether it is valid RGB value.
     '''
-    return np.isfinite(num) and num < (1 + e) and num > -e
+    return np.isfinite(num) & (num < (1 + e)) & (num > -e)
 
 
 #%% Plotting Functions
+def _pyplot():
+    '''
+    Imports pyplot (and the 3D axes used by the 3D plots) the first time
+    a plotting function is called, so the rest of this module can be
+    used without a plotting stack.
+    '''
+    import matplotlib.pyplot as plt
+    from mpl_toolkits.mplot3d import Axes3D # Used to make 3D axes
+    return plt
+
+
 def _plot_3D(ax, m, rgb, lims, ticks):
     '''
     Plots J'a'b' values of colormap in 3D space. Points are colored
@@ -498,9 +1309,8 @@ def _plot_3D(ax, m, rgb, lims, ticks):
     '''
 
     # Plot
-    for i in range(m.shape[1]):
-        c = tuple(rgb[:, i])
-        ax.scatter(m[1, i], m[2, i], m[0, i], c=c, alpha=0.3, s=80, lw=0)
+    ax.scatter(m[1, :], m[2, :], m[0, :], c=np.clip(rgb, 0, 1).T, alpha=0.3,
+               s=80, lw=0)
 
     # Format
     labels = ['J\'', 'a\'', 'b\'']
@@ -513,13 +1323,45 @@ def _plot_3D(ax, m, rgb, lims, ticks):
     ax.set_xticks([ticks[0], ticks[1]])
     ax.set_yticks([ticks[2], ticks[3]])
     ax.set_zticks([ticks[4], ticks[5]])
-    plt.xticks(fontsize=FAX)
-    plt.yticks(fontsize=FAX)
-    plt.axis('off')
+    ax.tick_params(axis='x', labelsize=FAX)
+    ax.tick_params(axis='y', labelsize=FAX)
+    ax.axis('off')
     return
 
 
-def plot_3D_colormap(jab, minJ, maxJ, name=None, maprevolve=False):
+def _render_3D_frames(args):
+    '''
+    Renders the 3D colormap plot (see plot_3D_colormap) at each angle
+    without pyplot, so it also works in worker processes. Frames are
+    saved to name + 'angle=X.png' or, if name is None, returned as PNG
+    data.
+    '''
+
+    from io import BytesIO
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    from matplotlib.figure import Figure
+    from mpl_toolkits.mplot3d import Axes3D # Used to make 3D axes
+
+    m, rgb, lims, angles, name = args
+    fig = Figure(figsize=(4, 4))
+    FigureCanvasAgg(fig)
+    ax = fig.add_subplot(111, projection='3d')
+    _plot_3D(ax, m, rgb, lims, lims)
+
+    frames = []
+    for a in angles:
+        ax.view_init(45, a)
+        if name is None:
+            buf = BytesIO()
+            fig.savefig(buf, format='png')
+            frames.append(buf.getvalue())
+        else:
+            fig.savefig(name + 'angle=' + str(a) + '.png')
+    return frames
+
+
+def plot_3D_colormap(jab, minJ, maxJ, name=None, maprevolve=False,
+                     buffers=False, processes=None, show=True):
     '''
     Plots colormap, showing all available J'a'b' values through
     CAM02-UCS space.
@@ -534,25 +1376,34 @@ def plot_3D_colormap(jab, minJ, maxJ, name=None, maprevolve=False):
     maxJ : int
         Maximum J value found to work with all a'b' pairs
     name : string
-        Name of file to be saved to. Make sure to include the file type
-        (e.g. .png, .pdf). If name is None, the file will not be saved.
-        Default value is None.
+        Start of the file names the rotation images are saved to (each
+        ends with 'angle=X.png'). If name is None, the files will not
+        be saved. Default value is None.
     maprevolve : boolean
         Decides whether full 3D rotation images will be plotted and
         saved for the 3D colormap plot. Extends total computation time
-        about 10X. Is considered False is name is None. Default value
-        is False.
+        about 10X. Is considered False is name is None and buffers is
+        False. Default value is False.
+    buffers : boolean
+        Decides whether the rotation images are returned as a list of
+        PNG data instead of saved to files. Default value is False.
+    processes : int
+        Number of worker processes the rotation images are rendered
+        in. If None or 1, they are rendered in this process. Default
+        value is None.
+    show : boolean
+        Decides whether the plot is shown. Default value is True.
 
     Returns
     -----------
-    None.
+    frames : list
+        PNG data of each rotation image if buffers is True, None
+        otherwise.
     '''
 
     m = np.copy(jab)
 
     # Set Up
-    fig = plt.figure(figsize=(4, 4))
-    ax = fig.add_subplot(111, projection='3d')
     topJ = _rnt(maxJ)
     botJ = _rnt(minJ)
     topa = _rnt(max(m[1, :]), shift='upper')
@@ -561,22 +1412,38 @@ def plot_3D_colormap(jab, minJ, maxJ, name=None, maprevolve=False):
     botb = _rnt(min(m[2, :]), shift='lower')
     lims = [bota, topa, botb, topb, botJ, topJ]
 
-    # Find RGBs for each possible J
-    for J in range(minJ, maxJ + 1):
-        m[0, :] = J
-        rgb = np.zeros(m.shape)
-        for col in range(m.shape[1]):
-            rgb[:, col] = convert(m[:, col], CSPACE2, CSPACE1)
-        _plot_3D(ax, m, rgb, lims, lims)
+    # Find RGBs for each possible J, all at once
+    Js = np.arange(int(ceil(minJ)), int(floor(maxJ)) + 1)
+    rgb = _iso_rgb(m, Js).reshape(3, -1)
+    m = np.vstack([np.repeat(Js[np.newaxis, :], m.shape[1], axis=0).ravel(),
+                   np.repeat(m[1:], len(Js), axis=1)])
 
     # Plot and save rotating image
-    if name is not None and maprevolve:
-        for a in np.arange(0, 360, 30):
-            ax.view_init(45, a)
-            plt.draw()
-            plt.savefig(name + 'angle=' + str(a) + '.png')
-    plt.show()
-    return
+    frames = None
+    if maprevolve and (name is not None or buffers):
+        if buffers:
+            name = None
+        angles = list(np.arange(0, 360, 30))
+        if processes is None or processes == 1:
+            frames = _render_3D_frames((m, rgb, lims, angles, name))
+        else:
+            from multiprocessing import Pool
+            jobs = [(m, rgb, lims, list(a), name)
+                    for a in np.array_split(angles, processes) if len(a)]
+            pool = Pool(processes)
+            try:
+                frames = sum(pool.map(_render_3D_frames, jobs), [])
+            finally:
+                pool.close()
+                pool.join()
+
+    if show:
+        plt = _pyplot()
+        fig = plt.figure(figsize=(4, 4))
+        ax = fig.add_subplot(111, projection='3d')
+        _plot_3D(ax, m, rgb, lims, lims)
+        plt.show()
+    return frames if buffers else None
 
 
 def plot_colormap(data, iso=False, ax=None):
@@ -619,28 +1486,25 @@ def plot_colormap(data, iso=False, ax=None):
         return None
 
     # Create plot
+    plt = _pyplot()
     newfig = ax == None
     if newfig:
         plt.figure(figsize=(6, 6))
         ax = plt.subplot(111)
 
-    # RGB values generated, now plot
+    # RGB values generated, now plot as one image (isoluminant maps are
+    # stacked from the bottom up)
     if len(rgb.shape) == 2:
-        for i in range(rgb.shape[1]):
-            c = tuple(rgb[:, i])
-            plt.scatter([i] * 100, np.linspace(0, 10, 100), c=c, lw=0)
+        img = np.transpose(rgb)[np.newaxis, :, :]
     else:
-        k = 10.0 / rgb.shape[2]
-        y = max(50 / rgb.shape[2], 5)
-        for j in range(rgb.shape[2]):
-            for i in range(rgb.shape[1]):
-                c = tuple(rgb[:, i, j])
-                plt.scatter([i] * y, np.linspace(k * j, k * (j + 1), y), c=c, lw=0)
+        img = np.transpose(rgb, (2, 1, 0))
+    ax.imshow(np.clip(img, 0, 1), origin='lower', interpolation='nearest',
+              extent=[0, rgb.shape[1], 0, 10])
 
     # Final formatting
     ax.set_aspect(5)
-    plt.axis([0, rgb.shape[1], 0, 10])
-    plt.axis('off')
+    ax.axis([0, rgb.shape[1], 0, 10])
+    ax.axis('off')
 
     return rgb
 
@@ -668,6 +1532,7 @@ def plot_colormap_info(fig, data, sp=[5, 1, 1], name=None, show=True, leg=False)
     None.
     '''
 
+    plt = _pyplot()
     rgb, m = get_rgb_jab(data)
 
     # Set up for figure
@@ -714,6 +1579,7 @@ def _plot_jab(m, leg=False):
     '''
     Plots J'a'b' values
     '''
+    plt = _pyplot()
 #    plt.title('CAM02-UCS Colorspace', fontsize=FLABEL)
     c1 = (45 / 255.0, 145 / 255.0, 167 / 255.0, 1)
     c2 = (220 / 255.0, 41 / 255.0, 12 / 255.0, 1)
@@ -736,11 +1602,10 @@ def _plot_pd(m, show=True):
     Plots perceptual deltas as shown in https://bids.github.io/colormap
     '''
 #    plt.title('Perceptual Deltas', fontsize=FLABEL)
-    d = np.zeros(m.shape[1] - 1)
-    for i in range(m.shape[1] - 1):
-        d[i] = _find_distance(m[:, i], m[:, i+1])
+    d = _find_distance(m[:, :-1], m[:, 1:])
 
     if show:
+        plt = _pyplot()
         ymax = max(3, np.max(d))
         plt.xlim(left=1, right=m.shape[1]-1)
         plt.ylim(bottom=0, top=ymax)
@@ -754,6 +1619,8 @@ def _plot_pd(m, show=True):
 
 
 def plot_linear_Js(low, high, j1, j2, name=None):
+    import matplotlib.patches as mpatches
+    plt = _pyplot()
     plt.figure(figsize=(6, 6))
     c1 = (99 / 255.0, 198 / 255.0, 10 / 255.0)
     c2 = (184 / 255.0, 156 / 255.0, 239 / 255.0)
@@ -765,7 +1632,7 @@ def plot_linear_Js(low, high, j1, j2, name=None):
     if j2 is not None:
         plt.plot(j2[0, :], 'k', lw=4.8)
         plt.plot(j2[0, :], c=c2, lw=4)
-    plt.axis([0, 256, 0, 100])
+    plt.axis([0, len(low), 0, 100])
     plt.xticks([])
     plt.yticks([0, 50, 100], fontsize=FAX)
     plt.ylabel('J\'', fontsize=FLABEL)
@@ -791,143 +1658,386 @@ def _correct_J(low, high, line, m):
         return None
 
 
+def _min_chord_slope(left, right):
+    '''
+    Returns the smallest slope from any point (i, left[i]) to any point
+    (j, right[j]) with i < j. For each j, only the upper convex hull of
+    the points before it can give the smallest slope, so the hull is
+    built up point by point and searched for the tangent from
+    (j, right[j]). Uses O(N) memory.
+    '''
+    left, right = left.tolist(), right.tolist()
+    hull = []  # indices of the upper hull of (i, left[i]), i < j
+    best = np.inf
+    for j in range(1, len(left)):
+
+        # Add point j - 1 to the hull
+        i = j - 1
+        while len(hull) > 1:
+            a, b = hull[-2], hull[-1]
+            if (left[b] - left[a]) * (i - a) <= (left[i] - left[a]) * (b - a):
+                hull.pop()
+            else:
+                break
+        hull.append(i)
+
+        # Slope to (j, right[j]) is unimodal along the hull
+        lo, hi = 0, len(hull) - 1
+        while lo < hi:
+            mid = (lo + hi) // 2
+            a, b = hull[mid], hull[mid + 1]
+            if (right[j] - left[b]) * (j - a) <= (right[j] - left[a]) * (j - b):
+                lo = mid + 1
+            else:
+                hi = mid
+        i = hull[lo]
+        best = min(best, (right[j] - left[i]) / float(j - i))
+    return best
+
+
+def _slope_range(low, high):
+    '''
+    Finds the range of slopes (per colormap index) a line can have
+    while staying between the low and high J' bounds. A line with slope
+    s fits if s * (j - i) <= high[j] - low[i] for every pair of indices
+    i, j. The tightest pairs are found on the convex hulls of the
+    bounds (see _min_chord_slope) rather than by testing every pair.
+    '''
+    low = np.asarray(low, dtype=float)
+    high = np.asarray(high, dtype=float)
+    if len(low) < 2:
+        return -np.inf, np.inf
+    return -_min_chord_slope(-high, -low), _min_chord_slope(low, high)
+
+
 def lin_fit(y):
-    x = range(256)
+    x = range(len(y))
     x = np.vstack([x, np.ones(len(x))]).T
-    a, _, _, _ = np.linalg.lstsq(x, y)
+    a, _, _, _ = np.linalg.lstsq(x, y, rcond=None)
     return (a * x)[:, 0]
 
 
-def correct_J(m, name=None, delta_slope=1, delta_b=1):
+def correct_J(m, name=None, delta_slope=None, delta_b=None, plot=True,
+              bounds=None):
+    '''
+    Makes J' of a colormap linear in two ways: fitted to the original
+    J' values and fitted to cover the largest possible J' range while
+    staying within the J' bounds of every a'b' pair (see
+    find_J_bounds). The steepest line is solved for directly from the
+    bounds and is given the same direction as the original J'.
+
+    Parameters
+    -----------
+    m : 3 x N ndarray
+        J'a'b' values of the colormap
+    name : string
+        Name of file the J' fit plot is saved to. If name is None, the
+        file will not be saved. Default value is None.
+    delta_slope, delta_b : float
+        No longer used (the steepest line is solved for exactly).
+        Passing them raises a DeprecationWarning.
+    plot : boolean
+        Decides whether the J' fits are plotted (see plot_linear_Js).
+        Default value is True.
+    bounds : tuple of ndarrays
+        Lowest and highest J' of each a'b' pair, if already found with
+        find_J_bounds(m, per_column=True). Default value is None.
+
+    Returns
+    -----------
+    m1 : 3 x N ndarray
+        J'a'b' values with J' fit to the original J'
+    m2 : 3 x N ndarray
+        J'a'b' values with J' fit to maximize its range. None if no
+        line fits within the bounds.
+    '''
+
+    if delta_slope is not None or delta_b is not None:
+        warnings.warn('delta_slope and delta_b are no longer used by '
+                      'correct_J', DeprecationWarning, stacklevel=2)
 
     # Get max and min boundaries for each a, b pair
-    l = m.shape[1]
-    high = np.zeros((l))
-    low = np.zeros((l))
-    for i in range(l):
-        l, h = find_J_bounds(m[:, i], report=False)
-        low[i], high[i] = l, h
+    n = m.shape[1]
+    if bounds is None:
+        _, _, low, high = find_J_bounds(m, report=False, per_column=True)
+    else:
+        low, high = bounds
+    x = np.arange(n)
 
     # Method 1: Fit to existing line
     m1 = np.copy(m)
-    slope, b = np.polyfit(range(256), m[0, :], 1)
-    line_fit = slope * np.copy(range(256)) + b
+    slope, b = np.polyfit(x, m[0, :], 1)
+    line_fit = slope * x + b
     if max(line_fit) > 99:
         temp = list(m[0, :] - 99)
         line_fit = lin_fit(temp) + (99 - np.max(lin_fit(temp)))
         if min(line_fit) < 1:
             if line_fit[0] < line_fit[-1]:
-                line_fit = np.linspace(1, 99, 256)
+                line_fit = np.linspace(1, 99, n)
             else:
-                line_fit = np.linspace(99, 1, 256)
+                line_fit = np.linspace(99, 1, n)
     m1[0, :] = line_fit
 
     # Method 2: Maximize change in J
     m2 = None
-#    if [x for x in (high - min(low)) if x < 0]
-    if m[0, 0] <= m[0, -1]:
-        delta_slope = -abs(delta_slope)
-        slope = high[-1] - low[0]
-        if slope < 0:
-            plot_linear_Js(low, high, m1, None, name=name)
-            return m1, None
-    else:
-        delta_slope = abs(delta_slope)
-        slope = low[-1] - high[0]
-        if slope > 0:
-            plot_linear_Js(low, high, m1, None, name=name)
-            return m1, None
-
-    max_b = max(high[0], high[-1])
-    while slope != 0:
-        b = low[0]
-        while b <= max_b:
-            line_fit = (slope / 256.0) * np.asarray(range(256)) + b
-#            plot_linear_Js(low, high, m1, m2)
-#            test_upper = [x for x in high - line_fit2 if x < 0]
-#            test_lower = [x for x in line_fit2 - low if x < 0]
-#            if len(test_upper) + len(test_lower) == 0:
-#                plot_linear_Js(low, high, line_fit1, line_fit2, name=name)
-#                m2 = np.copy(m)
-#                m2[0, :] = line_fit2
-#                return m1, m2
+    if not np.any(np.isnan(low)):
+        min_slope, max_slope = _slope_range(low, high)
+        if m[0, 0] <= m[0, -1]:
+            slope = max_slope
+            valid = 0 < slope < np.inf
+        else:
+            slope = min_slope
+            valid = -np.inf < slope < 0
+
+        # The steepest line only has one intercept that fits. Clip to
+        # absorb rounding error.
+        if valid and min_slope <= max_slope:
+            b = (np.max(low - slope * x) + np.min(high - slope * x)) / 2
+            line_fit = np.clip(slope * x + b, low, high)
             m2 = _correct_J(low, high, line_fit, m)
-            if m2 is not None:
-                plot_linear_Js(low, high, m1, m2, name=name)
-                return m1, m2
-            elif line_fit[-1] > high[-1] or line_fit[0] > high[0]:
-                b = 100
-            else:
-                b += delta_b
-        slope += delta_slope
-    plot_linear_Js(low, high, m1, None, name=name)
-    return m1, None
+
+    if plot:
+        plot_linear_Js(low, high, m1, m2, name=name)
+    return m1, m2
 
 
 # Make jab perceptually uniform
 def make_linear(jab, l=10000):
+    '''
+    Respaces the a'b' values of a colormap so neighboring entries are
+    the same distance apart in the a'b' plane. The a'b' path is
+    upsampled to l points, then resampled at evenly spaced arc lengths.
+    J' and both end points are not changed.
+
+    Parameters
+    -----------
+    jab : 3 x N ndarray
+        J'a'b' values of the colormap
+    l : int
+        Number of points the a'b' path is upsampled to. Default value
+        is 10000.
+
+    Returns
+    -----------
+    jab : 3 x N ndarray
+        J'a'b' values with linearized a' and b'
+    '''
 
     jab = np.copy(jab)
+    n = jab.shape[1]
 
     # Interpolate
-    old_x = range(256)
-    new_x = np.linspace(0, 255, l)
+    old_x = np.arange(n)
+    new_x = np.linspace(0, n - 1, l)
     long_a = np.interp(new_x, old_x, jab[1, :])
     long_b = np.interp(new_x, old_x, jab[2, :])
 
-    total_length = 0
-    for i in range(1, l):
-        total_length += _find_distance([long_a[i - 1], long_b[i - 1]],
-                                       [long_a[i], long_b[i]])
-    d = total_length / 255 # Desired distance between points
+    # Distance along the path to each point
+    dist = np.zeros(l)
+    np.cumsum(np.hypot(np.diff(long_a), np.diff(long_b)), out=dist[1:])
+    d = dist[-1] / (n - 1)  # Desired distance between points
 
     # Modify a & b
-    jab_ind = 0
-    long_ind = 1
-    d_this = 0
-    while jab_ind < 254 and long_ind < l - 1:
-        test_d1 = _find_distance([long_a[long_ind - 1], long_b[long_ind - 1]],
-                                [long_a[long_ind], long_b[long_ind]])
-        test_d2 = _find_distance([long_a[long_ind], long_b[long_ind]],
-                                [long_a[long_ind + 1], long_b[long_ind + 1]])
-
-        d_this += test_d1
-        d_next = d_this + test_d2
-        # If the distance to this point is a minima, add. Else, move onto next
-        if abs(d * (jab_ind + 1) - d_this) < abs(d *  (jab_ind + 1) - d_next):
-            jab_ind += 1
-            jab[1, jab_ind] = long_a[long_ind]
-            jab[2, jab_ind] = long_b[long_ind]
-        long_ind += 1
+    targets = d * np.arange(1, n - 1)
+    jab[1, 1:-1] = np.interp(targets, dist, long_a)
+    jab[2, 1:-1] = np.interp(targets, dist, long_b)
 
     return jab
 
 
-def overlay_colormap(img, cmap_rgb, ax=None, name=None, plot_ready=True):
-#    newfig = ax == None
-#    if newfig:
-#        plt.figure(figsize=(8, 4))
-#        ax = plt.subplot(1, 1, 1)
-    img = np.copy(img)
-    if plot_ready:
-        img_rgb = np.zeros((img.shape[0], img.shape[1], 3), dtype=np.uint8)
+def _lut_indices(img, n, vmin=None, vmax=None):
+    '''
+    Maps every value in img to the index of an n entry lookup table in
+    one pass. vmin maps to 0 and vmax to n - 1. If not given, they are
+    taken from the min and max of img (computed once).
+    '''
+    img = np.asarray(img, dtype=float)
+    if vmin is None:
+        vmin = np.min(img)
+    if vmax is None:
+        vmax = np.max(img)
+
+    idx = (img - vmin) * (n - 1)
+    if vmax > vmin:
+        idx /= vmax - vmin
     else:
-        img_rgb = np.zeros((img.shape[0], img.shape[1], 3), dtype=np.float16)
-    max_val = cmap_rgb.shape[1]
-    for i in range(img.shape[0]):
-        for j in range(img.shape[1]):
-            value = int(round(((img[i, j] - np.min(img)) * (max_val - 1)) / (np.max(img) - np.min(img))))
-            trgb = cmap_rgb[:, value]
-            if plot_ready:
-                img_rgb[i, j, :] = [trgb[0] * 255, trgb[1] * 255, trgb[2] * 255]
-            else:
-                img_rgb[i, j, :] = [trgb[0], trgb[1], trgb[2]]
-#    if newfig:
-#        plt.imshow(img_rgb)
-#        plt.axis('off')
-#        ax.set_aspect(1.2)
+        idx[...] = 0  # Flat image, use first entry
+    np.rint(idx, out=idx)
+    np.clip(idx, 0, n - 1, out=idx)
+    return idx.astype(np.intp)
 
-    return img_rgb
+
+def _build_lut(cmap_rgb, plot_ready=True):
+    '''
+    Turns a 3 x N colormap into an N x 3 lookup table in the output
+    dtype used by overlay_colormap (uint8 0-255 or float16 0-1).
+    '''
+    if plot_ready:
+        return (np.asarray(cmap_rgb).T * 255).astype(np.uint8)
+    return np.asarray(cmap_rgb).T.astype(np.float16)
+
+
+def _int_lut(lut, dtype, vmin, vmax):
+    '''
+    Expands an N x 3 lookup table to one entry for every value of an
+    unsigned integer dtype (uint8 or uint16), windowed by vmin and vmax
+    as in _lut_indices, so integer images index it directly.
+    '''
+    values = np.arange(np.iinfo(dtype).max + 1)
+    return np.take(lut, _lut_indices(values, lut.shape[0], vmin, vmax),
+                   axis=0)
+
+
+def resample_colormap(data, size=4096):
+    '''
+    Resamples a colormap to a different number of entries, interpolating
+    linearly between its colors in J'a'b'. Used to color images with
+    more distinct values than the colormap has colors, e.g. uint16
+    counts with overlay_colormap.
+
+    Parameters
+    -----------
+    data: string or 3 x N array
+        Colormap name OR array with complete color data. Invalid
+        colormap names throw a ValueError. Refer to _check_cmap for
+        more information.
+    size : int
+        Number of entries of the new colormap. Default value is 4096.
+
+    Returns
+    -----------
+    rgb : 3 x size ndarray
+        RGB values of the resampled colormap
+    '''
+    _, jab = get_rgb_jab(data)
+    n = jab.shape[1]
+    x = np.linspace(0, n - 1, size)
+    new = np.empty((3, size))
+    for i in range(3):
+        new[i] = np.interp(x, np.arange(n), jab[i])
+    return convert(new, CSPACE2, CSPACE1, out=new)
+
+
+def _stream_min_max(img, rows):
+    '''
+    Finds the min and max of an image reading rows at a time.
+    '''
+    vmin, vmax = np.inf, -np.inf
+    for start in range(0, img.shape[0], rows):
+        block = np.asarray(img[start:start + rows])
+        vmin = min(vmin, np.min(block))
+        vmax = max(vmax, np.max(block))
+    return vmin, vmax
+
+
+def _map_blocks(func, height, workers=None, rows=None):
+    '''
+    Calls func with a slice for each block of rows of an image with
+    the given height. Blocks are split over a pool of threads if
+    workers is more than 1 (NumPy releases the GIL for most array
+    operations). By default, there is one block per thread. Returns
+    the results in block order.
+    '''
+    if workers is None or workers < 1:
+        workers = 1
+    if rows is None:
+        rows = max(int(ceil(height / float(workers))), 1)
+    blocks = [slice(start, start + rows) for start in range(0, height, rows)]
+    if workers == 1 or len(blocks) == 1:
+        return [func(block) for block in blocks]
+
+    pool = ThreadPool(workers)
+    try:
+        return pool.map(func, blocks)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def overlay_colormap(img, cmap_rgb, ax=None, name=None, plot_ready=True,
+                     vmin=None, vmax=None, rows=None, out=None, workers=None):
+    '''
+    Colors an image with a colormap. Image values are scaled between
+    their min and max (or vmin and vmax) to the index of the colormap
+    entry used.
+
+    uint8 and uint16 images are colored through a table with an entry
+    for every possible value (built from the colormap and vmin/vmax),
+    so each pixel is colored with a single lookup. Resample the
+    colormap to more entries (see resample_colormap) to give close
+    values their own colors.
+
+    Images larger than memory can be colored in blocks of rows: img can
+    then be an np.memmap (or any array-like that supports slicing rows)
+    and out an output np.memmap. The min and max are found in a first
+    pass over the blocks (unless vmin and vmax are given) and each
+    block is then colored and written to out, so memory use depends on
+    the block size only.
+
+    Parameters
+    -----------
+    img : array
+        Image to be colored
+    cmap_rgb : 3 x N array
+        RGB values of the colormap
+    plot_ready : boolean
+        If True, returns uint8 values (0-255). Otherwise, returns
+        float16 values (0-1). Default value is True.
+    vmin, vmax : float
+        Values mapped to the first and last colormap entry. Default to
+        the min and max of img.
+    rows : int
+        Number of image rows colored at once. If None, the whole image
+        is colored at once. Default value is None.
+    out : array or string
+        Array (e.g. np.memmap) with shape img.shape + (3,) the colored
+        image is written to, or the name of a .npy file to create and
+        write it to (as a memory-mapped file). Default value is None.
+    workers : int
+        Number of threads the blocks are colored on. If rows is None,
+        the image is split into one block per thread. Results are the
+        same as with one thread. Default value is None (one thread).
+
+    Returns
+    -----------
+    img_rgb : ndarray
+        Colored image with shape img.shape + (3,) (out if given)
+    '''
+    lut = _build_lut(cmap_rgb, plot_ready=plot_ready)
+    blocks = rows is not None or out is not None or \
+        (workers is not None and workers > 1)
+    integer = getattr(img, 'dtype', None) in (np.uint8, np.uint16)
+    if not blocks and not integer:
+        idx = _lut_indices(img, lut.shape[0], vmin, vmax)
+        return np.take(lut, idx, axis=0)
+
+    if vmin is None or vmax is None:
+        img_min, img_max = _stream_min_max(img, rows or img.shape[0])
+        vmin = img_min if vmin is None else vmin
+        vmax = img_max if vmax is None else vmax
+    if integer:
+        lut = _int_lut(lut, img.dtype, vmin, vmax)
+        if not blocks:
+            return np.take(lut, img, axis=0)
+
+    # Colored in blocks
+    if out is None:
+        out = np.empty(tuple(img.shape) + (3,), dtype=lut.dtype)
+    elif isinstance(out, str):
+        out = np.lib.format.open_memmap(out, mode='w+', dtype=lut.dtype,
+                                        shape=tuple(img.shape) + (3,))
+
+    def color_block(block):
+        if integer:
+            idx = img[block]
+        else:
+            idx = _lut_indices(img[block], lut.shape[0], vmin, vmax)
+        out[block] = np.take(lut, idx, axis=0)
+
+    _map_blocks(color_block, img.shape[0], workers, rows)
+    if isinstance(out, np.memmap):
+        out.flush()
+    return out
 
 
 def test_colormap(cmap, ax=None, name=None):
@@ -945,18 +2055,183 @@ def test_colormap(cmap, ax=None, name=None):
     return img_rgb
 
 
+def _cdps_fit(x, y):
+    '''
+    Least squares fit of y vs. x along the last axis (one fit per
+    line). R^2 is found for the fitted slope with the intercept set to
+    0, as shown by cdps_plot.
+    '''
+    n = x.shape[-1]
+    sx = np.sum(x, axis=-1)
+    sy = np.sum(y, axis=-1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        slope = ((n * np.sum(x * y, axis=-1) - sx * sy) /
+                 (n * np.sum(x * x, axis=-1) - sx ** 2))
+        intercept = (sy - slope * sx) / n
+        yhat = slope[..., np.newaxis] * x
+        ybar = (sy / n)[..., np.newaxis]
+        r2 = np.sum((yhat - ybar) ** 2, axis=-1) / np.sum((y - ybar) ** 2,
+                                                          axis=-1)
+    return slope, intercept, r2
+
+
+def cdps(data, cmap_rgb, axis=1, gslope=1, vmin=None, vmax=None):
+    '''
+    Finds the color data perceptual sensitivity (CDPS) of a colormap
+    for every row and/or column of an image, without plotting. For each
+    line, perceptual deltas between neighboring pixels of the colored
+    image are fit against the absolute data deltas, as in cdps_plot.
+
+    Parameters
+    -----------
+    data : 2D array or list of 1D arrays
+        Image, or slices of data (each slice is treated as a row)
+    cmap_rgb : 3 x N array
+        RGB values of the colormap
+    axis : int or None
+        1 fits each row, 0 fits each column and None fits each row then
+        each column. Default value is 1.
+    gslope : float or string
+        Perceptual deltas are divided by this. If 'gray', the slope
+        and intercept of each line are instead divided by those found
+        with the gray colormap. Default value is 1.
+    vmin, vmax : float
+        Data values mapped to the ends of the colormap. Default to the
+        min and max of all the data.
+
+    Returns
+    -----------
+    slope : ndarray
+        Slope of the fit of each line
+    intercept : ndarray
+        Intercept of the fit of each line
+    r2 : ndarray
+        R^2 of each line
+    '''
+
+    # Slices of different lengths are done one at a time
+    if isinstance(data, (list, tuple)):
+        if len(set(len(d) for d in data)) > 1:
+            vmin = min(np.min(d) for d in data) if vmin is None else vmin
+            vmax = max(np.max(d) for d in data) if vmax is None else vmax
+            fits = [cdps(np.array(d, ndmin=2), cmap_rgb, axis=1,
+                         gslope=gslope, vmin=vmin, vmax=vmax) for d in data]
+            return tuple(np.concatenate(f) for f in zip(*fits))
+        axis = 1
+    img = np.array(data, dtype=float, ndmin=2)
+
+    if axis is None:
+        fits = [cdps(img, cmap_rgb, axis=a, gslope=gslope, vmin=vmin,
+                     vmax=vmax) for a in (1, 0)]
+        return tuple(np.concatenate(f) for f in zip(*fits))
+    if axis == 0:
+        img = img.T
+
+    # Color image through a J'a'b' lookup table (same colors as
+    # overlay_colormap with plot_ready=False)
+    lut = _build_lut(cmap_rgb, plot_ready=False)
+    jab_lut = convert(lut.T.astype(float), CSPACE1, CSPACE2)
+    idx = _lut_indices(img, lut.shape[0], vmin, vmax)
+    jab = jab_lut[:, idx]
+
+    # Get x and y
+    x = np.abs(np.diff(img, axis=-1))
+    y = np.sqrt(np.sum(np.diff(jab, axis=-1) ** 2, axis=0))
+    if gslope != 'gray':
+        y = y / gslope
+
+    slope, intercept, r2 = _cdps_fit(x, y)
+    if gslope == 'gray':
+        gray, _ = get_rgb_jab('gray', calc_jab=False)
+        g = cdps(img, gray, axis=1, vmin=vmin, vmax=vmax)[0]
+        slope = slope / g
+        intercept = intercept / g
+    return slope, intercept, r2
+
+
+def gradient_fidelity(img, cmap_rgb, chunk=256, vmin=None, vmax=None):
+    '''
+    Measures how well perceptual changes in a colored image follow the
+    changes in its data over the whole 2D image. At each pixel, the
+    magnitude of the data gradient and of the J'a'b' gradient of the
+    colored image (both from forward differences) are compared: a line
+    is fit through them and the ratio of the two is summarized. Pixels
+    where the data does not change are skipped.
+
+    The image is processed in blocks of rows so only one block of
+    J'a'b' values (float32) is held in memory at a time.
+
+    Parameters
+    -----------
+    img : 2D array
+        Image data. Can be any array-like that supports slicing rows
+        (e.g. np.memmap).
+    cmap_rgb : 3 x N array
+        RGB values of the colormap
+    chunk : int
+        Number of image rows processed at once. Default value is 256.
+    vmin, vmax : float
+        Data values mapped to the ends of the colormap. Default to the
+        min and max of img.
+
+    Returns
+    -----------
+    stats : dict
+        'n' (pixels used), 'slope', 'intercept' and 'r2' of the fit of
+        perceptual vs. data gradients, and 'ratio_mean' and 'ratio_std'
+        of perceptual / data gradient.
+    '''
+
+    lut = _build_lut(cmap_rgb, plot_ready=False)
+    jab_lut = convert(lut.T.astype(float), CSPACE1, CSPACE2).astype(np.float32)
+    if vmin is None:
+        vmin = np.min(img)
+    if vmax is None:
+        vmax = np.max(img)
+
+    # Running sums: n, x, y, x^2, y^2, xy, y/x, (y/x)^2
+    sums = np.zeros(8)
+    for start in range(0, img.shape[0] - 1, chunk):
+
+        # Block overlaps the next one by a row for the vertical gradient
+        block = np.asarray(img[start:start + chunk + 1], dtype=float)
+        jab = jab_lut[:, _lut_indices(block, lut.shape[0], vmin, vmax)]
+
+        x = np.hypot(np.diff(block, axis=1)[:-1],
+                     np.diff(block, axis=0)[:, :-1])
+        y = np.sqrt(np.sum(np.diff(jab, axis=2)[:, :-1] ** 2 +
+                           np.diff(jab, axis=1)[:, :, :-1] ** 2, axis=0))
+        keep = x > 0
+        x = x[keep]
+        y = y[keep].astype(float)
+        ratio = y / x
+        sums += [x.size, np.sum(x), np.sum(y), np.sum(x * x), np.sum(y * y),
+                 np.sum(x * y), np.sum(ratio), np.sum(ratio * ratio)]
+
+    n, sx, sy, sxx, syy, sxy, sr, srr = sums
+    with np.errstate(divide='ignore', invalid='ignore'):
+        cov = n * sxy - sx * sy
+        slope = cov / (n * sxx - sx ** 2)
+        r2 = cov ** 2 / ((n * sxx - sx ** 2) * (n * syy - sy ** 2))
+        stats = {'n': int(n), 'slope': slope,
+                 'intercept': (sy - slope * sx) / n, 'r2': r2,
+                 'ratio_mean': sr / n,
+                 'ratio_std': np.sqrt(max(srr / n - (sr / n) ** 2, 0))}
+    return stats
+
+
 def cdps_plot(img, cmap, rgb, num, gslope):
 
+    plt = _pyplot()
     plt.figure(figsize=(4, 4))
 
     img_overlay = overlay_colormap(img, rgb, plot_ready=False)[0, :, :]
-    slice_jab = convert(img_overlay.T, CSPACE1, CSPACE2)
+    slice_jab = np.moveaxis(convert(img_overlay, CSPACE1, CSPACE2, axis=-1),
+                            -1, 0)
 
     overlay_pd = _plot_pd(slice_jab, show=False)
 
-    data_pd = np.zeros(img_overlay.shape[0] - 1)
-    for i in range(data_pd.shape[0]):
-        data_pd[i] = img[0, i + 1] - img[0, i]
+    data_pd = np.diff(img[0, :])
 
     # Get x and y
     x = abs(data_pd)
@@ -6,8 +6,16 @@ Utilities for working in color vision deficiency (CVD) space
 (C) 2017 - Pacific Northwest National Laboratory
 """
 #%% Imports
+import hashlib
+from multiprocessing import Pool
+import os
+from os.path import exists, join
+import tempfile
+from time import time
+
 import numpy as np
 
+from colorspacious import machado_et_al_2009_matrix
 import cmaputil as cmu
 
 #%% Global Variables
@@ -15,75 +23,412 @@ SEV = 100
 CSPACE1 = cmu.CSPACE1
 CSPACE2 = cmu.CSPACE2
 CVD_TYPE = 'deuteranomaly'
+STAGES = ['make_linear', 'to_rgb', 'cvd', 'to_jab']  # iteration stages
+_CVD_MATRICES = {}  # CVD matrices already computed, by (cvd_type, severity)
+OPT_CACHE_DIR = join(cmu.CACHE_DIR, 'optimized')  # optimize_colormap results
+OPT_CACHE_SIZE = 100 * 2 ** 20  # max bytes kept in OPT_CACHE_DIR
+_OPT_CACHE_VERSION = 1  # change when optimize_colormap results change
 
 #%% Functions
 
-def get_cvd(data, cvd_type=CVD_TYPE, severity=100):
+def _cvd_matrix(cvd_type, severity):
+    '''
+    Returns the linear RGB CVD simulation matrix (Machado et al. 2009)
+    for this CVD type and severity. Matrices are cached.
+    '''
+    key = (cvd_type, float(severity))
+    if key not in _CVD_MATRICES:
+        _CVD_MATRICES[key] = machado_et_al_2009_matrix(cvd_type, severity)
+    return _CVD_MATRICES[key]
+
+def _to_linear(rgb):
+    # sRGB1 -> sRGB1-linear
+    return np.where(rgb < 0.04045, rgb / 12.92,
+                    ((rgb + 0.055) / 1.055) ** 2.4)
+
+def _from_linear(rgb, out=None):
+    # sRGB1-linear -> sRGB1, clipped to valid values
+    with np.errstate(invalid='ignore'):
+        rgb = np.where(rgb <= 0.0031308, rgb * 12.92,
+                       1.055 * rgb ** (1 / 2.4) - 0.055)
+    return np.clip(rgb, 0, 1, out=out)
+
+def get_cvd(data, cvd_type=CVD_TYPE, severity=100, axis=0, out=None,
+            unique=False):
     '''
     Converts RGB values to CVD space RGB values.
 
     Parameters
     ----------
-    data: string or 3 x 256 array
-        Colormap name OR array with complete color data. Invalid
-        colormap names throw a ValueError. Refer to _check_cmap for
-        more information.
+    data: string or 3 x ... array
+        Colormap name OR array with complete color data, with the 3
+        color components along axis (e.g. an H x W x 3 image with
+        axis=-1). Invalid colormap names throw a ValueError. Refer to
+        _check_cmap for more information.
     cvd_type: string
         Type of CVD to be simulated. Options: deuteranomaly or
         protanomaly. Default: deuteranomaly.
     severity: int
         Severity of CVD to be simulated. Can be any integer between 0
         and 100. Default: 100
+    axis: int
+        Axis holding the color components. Default: 0
+    out: array
+        Array with the shape of data the result is written to.
+        Default: None (a new array)
+    unique: boolean
+        If True, only the distinct colors in data are converted (see
+        cmu.unique_colors), e.g. for an image colored with a colormap.
+        Default: False
     Returns
     ----------
-    cvd: 3 x 256 array
-        Colormap data in CVD space
+    cvd: 3 x ... array
+        Colormap data in CVD space, laid out like data
     '''
 
     rgb,_ = cmu.get_rgb_jab(data, calc_jab=False)
-    cvd_space = {'name': 'sRGB1+CVD', 'cvd_type': cvd_type,
-                 'severity': severity}
-    cvd = cmu.convert(rgb, cvd_space, CSPACE1)
-    return cvd
+    if unique:
+        colors, inverse = cmu.unique_colors(rgb, axis)
+        colors = get_cvd(colors, cvd_type, severity, axis=-1)
+        if out is None:
+            out = np.empty(rgb.shape)
+        cvd = np.moveaxis(out, axis, -1)
+        cvd[...] = np.take(colors, inverse, axis=0).reshape(cvd.shape)
+        return out
 
-def _iter_make_linear(jab):
+    mat = _cvd_matrix(cvd_type, severity)
+    if rgb.ndim > 1 and axis % rgb.ndim == rgb.ndim - 1:
+        cvd = np.dot(_to_linear(rgb), mat.T)
+    else:
+        cvd = np.tensordot(mat, _to_linear(rgb), axes=(1, axis))
+        cvd = np.moveaxis(cvd, 0, axis)
+    return _from_linear(cvd, out=out)
+
+def get_cvd_batch(data, cvd_type=CVD_TYPE, severity=SEV):
+    '''
+    Converts RGB values to CVD space RGB values for several CVD types
+    and/or severities at once.
+
+    Parameters
+    ----------
+    data: string or 3 x 256 array
+        Colormap name OR array with complete color data. Invalid
+        colormap names throw a ValueError. Refer to _check_cmap for
+        more information.
+    cvd_type: string or list of strings
+        Type(s) of CVD to be simulated. Default: deuteranomaly.
+    severity: int or list of ints
+        Severities of CVD to be simulated. If both cvd_type and
+        severity are lists, they must be the same length and are
+        paired up. Default: 100
+    Returns
+    ----------
+    cvd: S x 3 x 256 array
+        Colormap data in CVD space for each of the S type/severity
+        pairs
+    '''
+
+    types = [cvd_type] if isinstance(cvd_type, str) else list(cvd_type)
+    sevs = list(np.atleast_1d(severity))
+    if len(types) == 1:
+        types = types * len(sevs)
+    elif len(sevs) == 1:
+        sevs = sevs * len(types)
+    if len(types) != len(sevs):
+        raise ValueError('cvd_type and severity must be the same length.')
+
+    rgb,_ = cmu.get_rgb_jab(data, calc_jab=False)
+    mats = np.array([_cvd_matrix(t, s) for t, s in zip(types, sevs)])
+    cvd = np.matmul(mats, _to_linear(rgb))
+    return _from_linear(cvd)
+
+def _iter_make_linear(jab, l=10000, times=None, cvd_type=CVD_TYPE,
+                      severity=SEV):
+
+    t = [time()]
 
     # Linearize a' and b' changes
-    jab1 = cmu.make_linear(np.copy(jab))
+    jab1 = cmu.make_linear(np.copy(jab), l=l)
+    t.append(time())
 
     # Convert J'a'b' values to RGB values and clip
-    rgb1 = np.clip(cmu.convert(jab1, CSPACE2, CSPACE1), 0, 1) 
+    rgb1 = np.clip(cmu.convert(jab1, CSPACE2, CSPACE1), 0, 1)
+    t.append(time())
 
     # Convert RGB to CVD RGB space
-    rgb2 = get_cvd(rgb1)
+    rgb2 = get_cvd(rgb1, cvd_type=cvd_type, severity=severity)
+    t.append(time())
 
     # Bring back to to J'a'b'
     jab2 = cmu.convert(rgb2, CSPACE1, CSPACE2)
 
     # Force to have same J' as original J'a'b' array
     jab2[0, :] = jab1[0, :]
+    t.append(time())
+
+    # Add time taken by each stage
+    if times is not None:
+        for stage, dt in zip(STAGES, np.diff(t)):
+            times[stage] = times.get(stage, 0) + dt
 
     return jab2
 
-def iter_make_linear(jab, l=100000):
+def iter_make_linear(jab, l=100000, tol=None, max_iter=2, report=False,
+                     stats=False, cvd_type=CVD_TYPE, severity=SEV):
     '''
-    Takes J'a'b' array and performs the following two times: linearizes
-    the change of a' and b' then converts to CVD space and back (to
-    ensure colormap is still CVD compatible).
+    Takes J'a'b' array and repeatedly linearizes the change of a' and
+    b' then converts to CVD space and back (to ensure colormap is still
+    CVD compatible). By default, this is done exactly two times. If tol
+    is given, it stops as soon as the largest change in J'a'b' made by
+    an iteration is below tol (after at most max_iter iterations).
 
     Parameters
     ----------
     data: 3 x 256 array
         J'a'b' values for colormap
+    l: int
+        Number of points used by make_linear. Default: 100000
+    tol: float
+        Largest change in J'a'b' allowed to stop iterating. If None,
+        max_iter iterations are always done. Default: None
+    max_iter: int
+        Maximum number of iterations. Default: 2
+    report: boolean
+        Whether to print iteration count, residual and time per stage.
+        Default: False
+    stats: boolean
+        Whether to also return iteration count, residual and time per
+        stage. Default: False
+    cvd_type: string
+        Type of CVD simulated. Default: deuteranomaly
+    severity: int
+        Severity of CVD simulated. Default: 100
     Returns
     ----------
     rgb: 3 x 256 array
         RGB data
     jab: 3 x 256 array
         J'a'b' data
+    info: dict
+        'iterations' done, 'residual' (largest change in J'a'b' made
+        by the last iteration) and 'times' (seconds spent per stage).
+        Only returned if stats is True.
     '''
 
     jab = np.copy(jab)
-    jab = _iter_make_linear(_iter_make_linear(jab))
+    times = {}
+    residual = None
+    iterations = 0
+    while iterations < max_iter:
+        new_jab = _iter_make_linear(jab, l=l, times=times, cvd_type=cvd_type,
+                                    severity=severity)
+        residual = float(np.max(np.abs(new_jab - jab)))
+        jab = new_jab
+        iterations += 1
+        if tol is not None and residual < tol:
+            break
+
+    t = time()
     rgb = cmu.convert(jab, CSPACE2, CSPACE1)
-    return rgb, jab
\ No newline at end of file
+    times['to_rgb'] = times.get('to_rgb', 0) + time() - t
+
+    info = {'iterations': iterations, 'residual': residual, 'times': times}
+    if report:
+        print('Iterations: %d, residual: %s' % (iterations, residual))
+        print(', '.join('%s: %.3fs' % (stage, times.get(stage, 0))
+                        for stage in STAGES))
+    if stats:
+        return rgb, jab, info
+    return rgb, jab
+
+def _cache_key(rgb, params):
+    '''
+    Returns a hash of the colormap RGB values and the parameters used
+    to optimize it.
+    '''
+    rgb = np.ascontiguousarray(rgb, dtype=float)
+    h = hashlib.sha1(rgb.tobytes())
+    h.update(repr((rgb.shape, sorted(params.items()),
+                   _OPT_CACHE_VERSION)).encode())
+    return h.hexdigest()
+
+def _cache_load(key):
+    '''
+    Returns the arrays cached under key or None if there are none.
+    Marks the entry as recently used.
+    '''
+    path = join(OPT_CACHE_DIR, key + '.npz')
+    try:
+        with np.load(path) as f:
+            arrays = dict(f)
+    except (IOError, OSError, ValueError):
+        return None
+    try:
+        os.utime(path, None)
+    except OSError:
+        pass  # Evicted by another process since it was read
+    return arrays
+
+def _cache_save(key, **arrays):
+    '''
+    Saves arrays under key, then deletes the least recently used
+    entries until the cache is within OPT_CACHE_SIZE bytes.
+    '''
+    if not exists(OPT_CACHE_DIR):
+        os.makedirs(OPT_CACHE_DIR)
+
+    # Write to a temporary file first so other processes never load a
+    # partially written entry
+    fd, tmp = tempfile.mkstemp(dir=OPT_CACHE_DIR, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            np.savez(f, **arrays)
+        os.chmod(tmp, 0o644)
+        os.replace(tmp, join(OPT_CACHE_DIR, key + '.npz'))
+    except BaseException:
+        os.remove(tmp)
+        raise
+
+    entries = []
+    for name in os.listdir(OPT_CACHE_DIR):
+        if name.endswith('.npz'):
+            try:
+                st = os.stat(join(OPT_CACHE_DIR, name))
+            except OSError:  # Removed by another process
+                continue
+            entries.append((st.st_mtime, st.st_size, name))
+    entries.sort()
+    total = sum(e[1] for e in entries)
+    for _, size, name in entries:
+        if total <= OPT_CACHE_SIZE:
+            break
+        try:
+            os.remove(join(OPT_CACHE_DIR, name))
+        except OSError:
+            pass
+        total -= size
+
+def optimize_colormap(data, cvd_type=CVD_TYPE, severity=SEV, l=100000,
+                      maximize=True, tol=None, max_iter=2, cache=False,
+                      bounds=False):
+    '''
+    Optimizes a colormap for CVD the same way cividis was made: the
+    colormap is converted to CVD space, its a' and b' changes are
+    linearized, its J' is made linear and it is then iterated on with
+    iter_make_linear. Nothing is plotted.
+
+    Parameters
+    ----------
+    data: string or 3 x 256 array
+        Colormap name OR array with complete color data. Invalid
+        colormap names throw a ValueError. Refer to _check_cmap for
+        more information.
+    cvd_type: string
+        Type of CVD to optimize for. Default: deuteranomaly
+    severity: int
+        Severity of CVD to optimize for. Default: 100
+    l: int
+        Number of points used by make_linear. Default: 100000
+    maximize: boolean
+        Whether J' is fit to cover the largest range possible (falls
+        back to fitting the original J' if that is not possible) or
+        fit to the original J'. See correct_J. Default: True
+    tol: float
+        Passed to iter_make_linear. Default: None
+    max_iter: int
+        Passed to iter_make_linear. Default: 2
+    cache: boolean
+        Whether results are read from and saved to the on-disk cache in
+        OPT_CACHE_DIR. Entries are keyed by a hash of the RGB values
+        and all other parameters. Default: False
+    bounds: boolean
+        Whether to also return the J' bounds the linear J' was fit
+        within. Default: False
+    Returns
+    ----------
+    rgb: 3 x 256 array
+        RGB data of the optimized colormap
+    jab: 3 x 256 array
+        J'a'b' data of the optimized colormap
+    low: 256 array
+        Lowest valid J' of each a'b' pair before the final iterations.
+        Only returned if bounds is True.
+    high: 256 array
+        Highest valid J' of each a'b' pair before the final iterations.
+        Only returned if bounds is True.
+    '''
+
+    rgb, _ = cmu.get_rgb_jab(data, calc_jab=False)
+    if cache:
+        key = _cache_key(rgb, {'cvd_type': cvd_type, 'severity': severity,
+                               'l': l, 'maximize': maximize, 'tol': tol,
+                               'max_iter': max_iter})
+        arrays = _cache_load(key)
+        if arrays is not None:
+            if bounds:
+                return (arrays['rgb'], arrays['jab'], arrays['low'],
+                        arrays['high'])
+            return arrays['rgb'], arrays['jab']
+
+    # Simulate CVD and make perceptual deltas (a' vs. b') uniform
+    rgb = get_cvd(rgb, cvd_type=cvd_type, severity=severity)
+    _, jab = cmu.get_rgb_jab(rgb)
+    jab = cmu.make_linear(jab, l=l)
+
+    # Linearize J'
+    _, _, low, high = cmu.find_J_bounds(jab, report=False, per_column=True)
+    jab_fit, jab_range = cmu.correct_J(jab, plot=False, bounds=(low, high))
+    if maximize and jab_range is not None:
+        jab = jab_range
+    else:
+        jab = jab_fit
+
+    rgb, jab = iter_make_linear(jab, l=l, tol=tol, max_iter=max_iter,
+                                cvd_type=cvd_type, severity=severity)
+
+    if cache:
+        _cache_save(key, rgb=rgb, jab=jab, low=low, high=high)
+    if bounds:
+        return rgb, jab, low, high
+    return rgb, jab
+
+def _optimize_one(args):
+    # Pool worker for optimize_colormaps
+    cmap, kwargs = args
+    try:
+        return optimize_colormap(cmap, **kwargs)
+    except ValueError as e:
+        print(str(cmap) + ' failed: ' + str(e))
+        return None
+
+def optimize_colormaps(cmaps=cmu.CMAPS, processes=None, **kwargs):
+    '''
+    Runs optimize_colormap on several colormaps in parallel.
+
+    Parameters
+    ----------
+    cmaps: list of strings
+        Colormap names. Default: all colormaps in CMAPS
+    processes: int
+        Number of worker processes. If 1, colormaps are optimized in
+        this process. Default: None (one per CPU)
+    kwargs:
+        Passed to optimize_colormap
+    Returns
+    ----------
+    results: dict
+        (rgb, jab) of each optimized colormap by name. Colormaps that
+        could not be optimized (e.g. invalid names) map to None.
+    '''
+
+    jobs = [(cmap, kwargs) for cmap in cmaps]
+    if processes == 1:
+        results = [_optimize_one(job) for job in jobs]
+    else:
+        pool = Pool(processes)
+        try:
+            results = pool.map(_optimize_one, jobs)
+        finally:
+            pool.close()
+            pool.join()
+    return dict(zip(cmaps, results))
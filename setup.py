@@ -35,5 +35,6 @@ setup(
     url='https://github.com/pnnl/cmaputil',
     license=license,
     packages=pkgs,
+    package_data={'cmaputil': ['colormaps/*.txt']},
     install_requires=required
 )